@@ -1,10 +1,30 @@
 import os
+import json
+import uuid
+import glob
+import hashlib
+import hmac
+import click
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory, abort
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, stream_template, make_response, request, redirect, url_for, flash, session, abort, jsonify
 from sqlalchemy import inspect, func
+from sqlalchemy.orm import joinedload
 from config import SQLALCHEMY_DATABASE_URI, SECRET_KEY
-from models import db, Rank, User, Book, Chapter, Comment
+try:
+  from config import SQLALCHEMY_REPLICA_URI
+except ImportError:  # config.py anterior a la replica
+  SQLALCHEMY_REPLICA_URI = None
+from models import db, replica_router, Rank, User, Book, Chapter, Comment, ChapterTerms, UploadSession
+from search import book_search, chapter_search, extract_chapter, tokenize
+from search.ranking import fetch_in_order
+from pagination import Page, SortKey, keyset_paginate
+from result_cache import result_cache
+from serving import send_upload
+from storage import LocalStorage, blob_storage
+from plan_check import plan_check_command
+from db_pool import db_pool
+from rendering import html_cache, render_service, prerender, read_index, read_section, iter_rendered, render_blocks, remove_rendered
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
@@ -14,11 +34,42 @@ app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
 app.config["SECRET_KEY"] = SECRET_KEY
 app.config["SQLALCHEMY_ECHO"] = False # para debug
+if SQLALCHEMY_REPLICA_URI:
+  app.config["SQLALCHEMY_BINDS"] = {"replica": SQLALCHEMY_REPLICA_URI}
+app.config["REPLICA_STICKY_SECONDS"] = 5  # lecturas al primario despues de que el usuario escribe
+# pool de conexiones por worker (ver db_pool.py); el recycle tiene que quedar debajo del wait_timeout de MySQL
+app.config["DB_POOL_SIZE"] = int(os.getenv("DB_POOL_SIZE", "5"))
+app.config["DB_POOL_MAX_OVERFLOW"] = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+app.config["DB_POOL_TIMEOUT"] = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+app.config["DB_POOL_RECYCLE"] = int(os.getenv("DB_POOL_RECYCLE", "280"))
+app.config["DB_POOL_PRE_PING"] = os.getenv("DB_POOL_PRE_PING", "1") != "0"
+app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN", "")  # sin token /metrics/* no existe
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
-app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024  # 20 mb
+app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024  # 20 mb (por request: el formulario y cada parte)
+app.config["UPLOAD_MAX_SIZE"] = 200 * 1024 * 1024  # 200 mb por archivo en las subidas por partes
+app.config["UPLOAD_CHUNK_SIZE"] = 4 * 1024 * 1024  # tamaño de parte que se le propone al navegador
+app.config["COMMENTS_PER_PAGE"] = 20
+app.config["READER_STREAM_THRESHOLD"] = 1024 * 1024  # .md mas grandes se leen en streaming
+app.config["UPLOADS_SERVE_MODE"] = "python"  # o "x-accel" (nginx) / "x-sendfile" (apache), ver serving.py
+# donde se guardan los archivos: "local" (UPLOAD_FOLDER) o "s3" (bucket compartido entre nodos, ver storage/backends.py)
+app.config["STORAGE_BACKEND"] = os.getenv("STORAGE_BACKEND", "local")
+app.config["S3_BUCKET"] = os.getenv("S3_BUCKET", "")
+app.config["S3_PREFIX"] = os.getenv("S3_PREFIX", "")
+app.config["S3_ENDPOINT_URL"] = os.getenv("S3_ENDPOINT_URL") or None  # MinIO / moto_server; sin valor = AWS
+app.config["S3_REGION"] = os.getenv("S3_REGION") or None
+app.config["UPLOADS_URL_EXPIRES"] = 300  # segundos de validez de las URLs firmadas (s3)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+db_pool.init_app(app)  # antes de db.init_app: arma SQLALCHEMY_ENGINE_OPTIONS
 db.init_app(app)
+replica_router.init_app(app)
+book_search.init_app(app)
+chapter_search.init_app(app)
+result_cache.init_app(app)
+html_cache.init_app(app)
+render_service.init_app(app)
+blob_storage.init_app(app)
+app.cli.add_command(plan_check_command)
 
 #--------------------
 #Funciones utilizadas
@@ -31,6 +82,59 @@ def require_login():
     if "user_id" not in session:
         return False
     return True
+
+def query_key(q: str):
+  # misma clave para "Canción" y "cancion  " (se busca igual)
+  return tuple(tokenize(q)) if q else None
+
+def cached_books(key, build_ids, tags=("books",)) -> list:
+  # los ids del listado salen del cache (o de la db la primera vez) y despues solo se trae por PK
+  ids = result_cache.get_or_set(key, build_ids, tags)
+  return fetch_in_order(Book.query, Book.id, ids)
+
+# columnas de las tarjetas del home
+CARD_COLUMNS = (Book.id, Book.title, Book.subtitle, Book.creator_user_id, Book.creation_date, Book.last_update_date)
+
+def cached_rows(key, statement, tags=("books",)) -> list:
+  # listados chicos que se muestran tal cual: se guardan las filas (inmutables, sin sesion) y no
+  # los ids, asi un acierto no toca la db. Un fallo es una sola consulta
+  return result_cache.get_or_set(key, lambda: db.session.execute(statement).all(), tags)
+
+# las plantillas son parte de la pagina: un deploy que las cambia invalida los ETag viejos
+TEMPLATES_VERSION = max(
+  (os.path.getmtime(p) for p in glob.glob(os.path.join(BASE_DIR, "templates", "*.html"))),
+  default=0,
+)
+
+def page_etag(*state) -> str:
+  # ETag de una pagina: el estado de lo que muestra + quien la mira (los botones cambian segun el usuario)
+  # + los mensajes flash pendientes (la pagina que los muestra es otra version)
+  raw = repr((TEMPLATES_VERSION, session.get("user_id"), request.full_path, session.get("_flashes")) + state)
+  return hashlib.sha1(raw.encode()).hexdigest()
+
+def not_modified(etag: str, last_modified=None):
+  # respuesta 304 si el navegador ya tiene esta version; None si hay que armar la pagina
+  if session.get("_flashes"):
+    return None  # hay mensajes para mostrar: la copia del navegador no los tiene
+  if last_modified is not None and last_modified.tzinfo is None:
+    last_modified = last_modified.replace(tzinfo=timezone.utc)  # la db devuelve UTC sin zona
+  if request.if_none_match:
+    fresh = request.if_none_match.contains_weak(etag)
+  else:
+    fresh = bool(last_modified and request.if_modified_since and last_modified.replace(microsecond=0) <= request.if_modified_since)
+  if not fresh:
+    return None
+  return with_validators(app.response_class(status=304), etag, last_modified)
+
+def with_validators(response, etag: str, last_modified=None):
+  # private + no-cache: el navegador la guarda pero siempre pregunta (con If-None-Match)
+  response = make_response(response)
+  response.set_etag(etag, weak=True)
+  if last_modified is not None:
+    response.last_modified = last_modified
+  response.cache_control.private = True
+  response.cache_control.no_cache = True
+  return response
   
 #--------------------
 #Login
@@ -92,38 +196,39 @@ def home():
   scope = request.args.get("scope", "all")
   sort = request.args.get("sort", "updated_desc")
 
-  books_query = Book.query
-  if scope == "mine":
-    books_query = books_query.filter(Book.creator_user_id == user_id)
+  def search_ids():
+    books_query = Book.query
+    if scope == "mine":
+      books_query = books_query.filter(Book.creator_user_id == user_id)
+    books_query, keep = book_search.restrict(books_query, book_search.match_ids(q))
+
+    if sort == "created_desc":
+      keys = [SortKey(Book.creation_date, desc=True), SortKey(Book.id, desc=True)]
+    else:
+      keys = [SortKey(Book.last_update_date, desc=True), SortKey(Book.id, desc=True)]
+    return [book.id for book in keyset_paginate(books_query, keys, None, 20, "home", keep=keep)]
 
+  # sin q no hay nada que buscar (el home no lista resultados propios)
+  search_results = []
   if q:
-    like = f"%{q}%"
-    books_query = books_query.filter(
-      db.or_(
-        Book.title.ilike(like),
-        Book.subtitle.ilike(like),
-        Book.description.ilike(like),
-      )
+    search_results = cached_books(
+      ("home", query_key(q), user_id if scope == "mine" else None, sort),
+      search_ids,
     )
 
-  if sort == "created_desc":
-    books_query = books_query.order_by(Book.creation_date.desc())
-  else:
-    books_query = books_query.order_by(Book.last_update_date.desc())
-
-  search_results = books_query.limit(20).all() 
-
-  last_5_mine = (
-    Book.query.filter_by(creator_user_id=user_id)
+  last_5_mine = cached_rows(
+    ("home:mine", user_id),
+    db.select(*CARD_COLUMNS)
+    .where(Book.creator_user_id == user_id)
     .order_by(Book.creation_date.desc())
-    .limit(5)
-    .all()
+    .limit(5),
   )
 
-  last_10_updated = (
-    Book.query.order_by(Book.last_update_date.desc())
-    .limit(10)
-    .all()
+  # igual para todos los usuarios: una sola copia por proceso, se renueva al escribir un libro
+  # (tag "books") o a los RESULT_CACHE_TTL segundos. Usa el indice de last_update_date
+  last_10_updated = cached_rows(
+    ("home:updated",),
+    db.select(*CARD_COLUMNS).order_by(Book.last_update_date.desc()).limit(10),
   )
 
   return render_template(
@@ -142,12 +247,14 @@ def my_books():
   if "user_id" not in session:
     return redirect(url_for("login"))
   user_id = session["user_id"]
-  books = (
-    Book.query.filter_by(creator_user_id=user_id)
-    .order_by(Book.creation_date.desc())
-    .all()
+  pagination = keyset_paginate(
+    Book.query.filter_by(creator_user_id=user_id),
+    [SortKey(Book.creation_date, desc=True), SortKey(Book.id, desc=True)],
+    request.args.get("cursor"),
+    per_page=18,
+    scope="my_books",
   )
-  return render_template("my_books.html", books=books)
+  return render_template("my_books.html", books=pagination.items, pagination=pagination)
 
 #Pagina principal de un libro
 @app.route("/books/<int:book_id>", methods=["GET", "POST"])
@@ -155,19 +262,38 @@ def book_detail(book_id):
   if "user_id" not in session:
     return redirect(url_for("login"))
 
+  if request.method != "POST":
+    # GET y HEAD: una sola consulta barata (libro + estado de los comentarios) antes de armar la pagina
+    state = db.session.execute(
+      db.select(
+        Book.last_update_date,
+        Book.chapters_count,
+        db.select(func.count(Comment.id)).where(Comment.book_id == Book.id).scalar_subquery(),
+        db.select(func.max(Comment.id)).where(Comment.book_id == Book.id).scalar_subquery(),
+        db.select(func.max(Comment.last_update_date)).where(Comment.book_id == Book.id).scalar_subquery(),
+      ).where(Book.id == book_id)
+    ).first()
+    if state is None:
+      abort(404)
+    etag = page_etag(*state)
+    last_modified = max(d for d in (state[0], state[4]) if d is not None)
+    cached = not_modified(etag, last_modified)
+    if cached is not None:
+      return cached
+
   book = Book.query.get_or_404(book_id)
 
   if request.method == "POST":
     action = request.form.get("action")
 
     # para volver a la misma página de capítulos después de la acción
-    current_page = request.args.get("page", 1, type=int)
+    current_cursor = request.args.get("cursor")
 
     if action == "create_comment":
       content = request.form.get("content", "").strip()
       if not content:
         flash("El comentario no puede estar vacío", "danger")
-        return redirect(url_for("book_detail", book_id=book.id, page=current_page))
+        return redirect(url_for("book_detail", book_id=book.id, cursor=current_cursor))
 
       cm = Comment(
         commentator_user_id=session["user_id"],
@@ -178,7 +304,7 @@ def book_detail(book_id):
       # book.last_update_date = func.now()
       db.session.commit()
       flash("Comentario publicado", "success")
-      return redirect(url_for("book_detail", book_id=book.id, page=current_page))
+      return redirect(url_for("book_detail", book_id=book.id, cursor=current_cursor))
 
     elif action == "edit_comment":
       comment_id = request.form.get("comment_id", type=int)
@@ -189,12 +315,12 @@ def book_detail(book_id):
         abort(403)
       if not content:
         flash("El comentario no puede quedar vacío", "danger")
-        return redirect(url_for("book_detail", book_id=book.id, page=current_page))
+        return redirect(url_for("book_detail", book_id=book.id, cursor=current_cursor))
 
       cm.content = content
       db.session.commit()
       flash("Comentario actualizado", "success")
-      return redirect(url_for("book_detail", book_id=book.id, page=current_page))
+      return redirect(url_for("book_detail", book_id=book.id, cursor=current_cursor))
 
     elif action == "delete_comment":
       comment_id = request.form.get("comment_id", type=int)
@@ -206,33 +332,53 @@ def book_detail(book_id):
       db.session.delete(cm)
       db.session.commit()
       flash("Comentario eliminado", "info")
-      return redirect(url_for("book_detail", book_id=book.id, page=current_page))
+      return redirect(url_for("book_detail", book_id=book.id, cursor=current_cursor))
 
     else:
       flash("Acción no válida", "danger")
-      return redirect(url_for("book_detail", book_id=book.id, page=current_page))
-
-  page = request.args.get("page", 1, type=int)
-  per_page = 10
-  pagination = (
-    Chapter.query.filter_by(book_id=book.id)
-    .order_by(Chapter.id.asc())
-    .paginate(page=page, per_page=per_page, error_out=False)
+      return redirect(url_for("book_detail", book_id=book.id, cursor=current_cursor))
+
+  pagination = keyset_paginate(
+    Chapter.query.filter_by(book_id=book.id),
+    [SortKey(Chapter.id)],
+    request.args.get("cursor"),
+    per_page=10,
+    scope=f"chapters:{book.id}",
   )
   chapters = pagination.items
 
-  comments = (
-    Comment.query.filter_by(book_id=book.id)
-    .order_by(Comment.creation_date.desc())
-    .all()
-  )
-
-  return render_template(
+  page = render_template(
     "book_detail.html",
     book=book,
     chapters=chapters,
     pagination=pagination,
-    comments=comments,
+    comments=comments_page(book.id, request.args.get("comments")),
+  )
+  return with_validators(page, etag, last_modified)
+
+def comments_page(book_id: int, cursor: str | None) -> Page:
+  # los mas nuevos primero, de a COMMENTS_PER_PAGE. El autor viene en el mismo SELECT (join):
+  # la pagina cuesta lo mismo con 10 que con 2000 comentarios.
+  # Por id y no por fecha: es el mismo orden y (book_id, id) ya esta en el indice de book_id
+  return keyset_paginate(
+    Comment.query.filter_by(book_id=book_id).options(joinedload(Comment.commentator)),
+    [SortKey(Comment.id, desc=True)],
+    cursor,
+    per_page=app.config["COMMENTS_PER_PAGE"],
+    scope=f"comments:{book_id}",
+  )
+
+#Siguiente pagina de comentarios (fragmento HTML para "Cargar más")
+@app.route("/books/<int:book_id>/comments")
+def book_comments(book_id):
+  if "user_id" not in session:
+    abort(401)
+  book = Book.query.get_or_404(book_id)
+  return render_template(
+    "book_comments.html",
+    book=book,
+    comments=comments_page(book.id, request.args.get("cursor")),
+    chapters_cursor=request.args.get("chapters"),
   )
 
 #Edicion de libro
@@ -273,7 +419,12 @@ def delete_book(book_id):
     abort(403)
 
   for ch in Chapter.query.filter_by(book_id=book.id).all():
-    # content_url -> /uploads/<filename>
+    # los archivos del almacenamiento por contenido se liberan por refcount al borrar el capitulo
+    db.session.delete(ch)
+    if ch.blob_sha256:
+      continue
+
+    # capitulos viejos: content_url -> /uploads/<filename>
     filename = None
     if ch.content_url:
       # maneja URL generada por url_for (path local)
@@ -286,10 +437,9 @@ def delete_book(book_id):
         filename = None
 
     if filename:
-      fpath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
       try:
-        if os.path.exists(fpath):
-          os.remove(fpath)
+        blob_storage.backend.delete(filename)
+        remove_rendered(blob_storage.backend, filename)
       except Exception:
         pass
 
@@ -300,44 +450,74 @@ def delete_book(book_id):
 
 
 #Busqueda avanzada
+def search_page(q: str, sort: str, cursor: str | None, per_page: int) -> dict:
+  # una pagina de /search como ids + cursores, que es lo que se guarda en el cache
+  scope = f"search:{sort}"
+  base = Book.query
+
+  # si la busqueda exacta no encuentra nada se prueba tolerando errores de tipeo
+  approximate = False
+  keep = None
+  if q and sort != "relevance":
+    ids = book_search.match_ids(q)
+    if not ids:
+      ids = book_search.fuzzy_ids(q)
+      approximate = bool(ids)
+    base, keep = book_search.restrict(base, ids)
+
+  if sort == "relevance":
+    # el orden lo da el indice (BM25): solo se traen de la db los libros de la pagina
+    pagination = book_search.page_by_relevance(base, q, cursor, per_page, scope)
+    if not pagination.items and not pagination.has_prev:
+      ids = book_search.fuzzy_ids(q)
+      pagination = book_search.page_ids(base, ids, cursor, per_page, scope)
+      approximate = bool(ids)
+  else:
+    # paginacion por cursor sobre las claves del orden (siempre terminan en id)
+    if sort == "creator_az":
+      base = base.join(User, User.id == Book.creator_user_id)
+      keys = [SortKey(User.username, get=lambda b: b.creator.username), SortKey(Book.id)]
+    elif sort == "created_desc":
+      keys = [SortKey(Book.creation_date, desc=True), SortKey(Book.id, desc=True)]
+    elif sort == "chapters_desc":
+      keys = [SortKey(Book.chapters_count, desc=True), SortKey(Book.title), SortKey(Book.id)]
+    else:  # "updated_desc" default
+      keys = [SortKey(Book.last_update_date, desc=True), SortKey(Book.id, desc=True)]
+
+    pagination = keyset_paginate(base, keys, cursor, per_page, scope, keep=keep)
+
+  return {
+    "ids": [b.id for b in pagination.items],
+    "cursor": pagination.cursor,
+    "next": pagination.next_cursor,
+    "prev": pagination.prev_cursor,
+    "approximate": approximate,
+  }
+
 @app.route("/search")
 def search():
   if "user_id" not in session:
     return redirect(url_for("login"))
 
   q = request.args.get("q", "", type=str).strip()
-  sort = request.args.get("sort", "updated_desc")
-  page = request.args.get("page", 1, type=int)
-  per_page = 18
-
-  base = db.session.query(
-    Book,
-    func.count(Chapter.id).label("chapters_count")
-  ).outerjoin(Chapter, Chapter.book_id == Book.id)
-
-  if q:
-    like = f"%{q}%"
-    base = base.filter(
-      db.or_(
-        Book.title.ilike(like),
-        Book.subtitle.ilike(like),
-        Book.description.ilike(like),
-      )
-    )
-    
-  base = base.group_by(Book.id)
-
-  if sort == "creator_az":
-    base = base.join(User, User.id == Book.creator_user_id).order_by(User.username.asc())
-  elif sort == "created_desc":
-    base = base.order_by(Book.creation_date.desc())
-  elif sort == "chapters_desc":
-    base = base.order_by(func.count(Chapter.id).desc(), Book.title.asc())
-  else:  # "updated_desc" default
-    base = base.order_by(Book.last_update_date.desc())
+  sort = request.args.get("sort") or ("relevance" if q else "updated_desc")
+  if sort == "relevance" and not q:
+    sort = "updated_desc"
+  cursor = request.args.get("cursor")
+
+  # el orden por cantidad de capitulos tambien cambia con cada alta/baja de capitulo
+  tags = ("books", "chapters") if sort == "chapters_desc" else ("books",)
+  page = result_cache.get_or_set(
+    ("search", query_key(q), sort, cursor),
+    lambda: search_page(q, sort, cursor, per_page=18),
+    tags,
+  )
+  results = fetch_in_order(Book.query, Book.id, page["ids"])
+  pagination = Page(results, cursor=page["cursor"], next_cursor=page["next"], prev_cursor=page["prev"])
+  approximate = page["approximate"]
 
-  pagination = base.paginate(page=page, per_page=per_page, error_out=False)
-  results = pagination.items
+  # capitulos cuyo contenido coincide (solo en la primera pagina)
+  chapter_results = chapter_search.search(q) if q and not pagination.has_prev else []
 
   return render_template(
     "advanced_search.html",
@@ -345,14 +525,30 @@ def search():
     sort=sort,
     results=results,
     pagination=pagination,
+    chapter_results=chapter_results,
+    approximate=approximate,
   )
 
+#Autocompletado del buscador (sale de memoria, no toca la db por cada tecla)
+@app.route("/search/suggest")
+def search_suggest():
+  if "user_id" not in session:
+    abort(401)
+
+  q = request.args.get("q", "", type=str).strip()
+  limit = min(request.args.get("limit", 8, type=int), 20)
+  results = [
+    {"id": book_id, "title": title, "url": url_for("book_detail", book_id=book_id)}
+    for book_id, title in book_search.suggest(q, limit)
+  ]
+  return jsonify(q=q, results=results)
+
 #archivos
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename):
   if "user_id" not in session:
     return redirect(url_for("login"))
-  return send_from_directory(app.config["UPLOAD_FOLDER"], filename, as_attachment=False)
+  return send_upload(filename)
 
 #Crear libro
 @app.route("/books/new", methods=["GET", "POST"])
@@ -409,24 +605,161 @@ def new_chapter(book_id):
       flash("Formato inválido. Solo .pdf o .md", "danger")
       return redirect(url_for("new_chapter", book_id=book.id))
 
-    filename = secure_filename(file.filename)
-    final_name = f"{book.id}_{session['user_id']}_{filename}"
-    save_path = os.path.join(app.config["UPLOAD_FOLDER"], final_name)
-    file.save(save_path)
-
-    content_url = url_for("uploaded_file", filename=final_name)
-
-    c = Chapter(book_id=book.id, title=title, content_url=content_url)
-    db.session.add(c)
-    
-    book.last_update_date = func.now()
-    db.session.commit()
+    # se guarda por contenido (sha256): si el mismo archivo ya estaba se reutiliza
+    _, ext = os.path.splitext(file.filename.lower())
+    add_chapter(book, title, blob_storage.save(file.stream, ext))
 
     flash("Capítulo agregado", "success")
     return redirect(url_for("book_detail", book_id=book.id))
 
   return render_template("new_chapter.html", book=book)
 
+def add_chapter(book, title: str, blob):
+  # alta del capitulo una vez que el archivo ya esta en el almacenamiento
+  backend = blob_storage.backend
+  c = Chapter(book_id=book.id, title=title, content_url=url_for("uploaded_file", filename=blob.key), blob=blob)
+  db.session.add(c)
+
+  # el markdown se renderiza una sola vez aca y el lector sirve el HTML guardado
+  # (un .md repetido ya tiene su render: el hash del render es el mismo sha256 del blob)
+  is_md = blob.ext == ".md"
+  if is_md:
+    c.content_hash = blob.sha256 if read_index(backend, blob.key, blob.sha256) else prerender(backend, blob.key)
+
+  # se indexa una sola vez al subir (los .md se leen linea por linea)
+  terms, snippets = extract_chapter(title, backend.open(blob.key) if is_md else None)
+  c.search_terms = ChapterTerms(terms=json.dumps(terms), snippets=json.dumps(snippets))
+
+  book.last_update_date = func.now()
+  db.session.commit()
+  return c
+
+#--------------------
+#Subidas por partes (archivos grandes): se abre una sesion, se mandan las partes en orden
+#(PUT con el cuerpo crudo, sin multipart) y al final se arma el capitulo. Si se corta la conexion
+#el navegador pregunta cuanto llego y sigue desde ahi.
+#Cada byte se escribe una sola vez: las partes van directo al .part, que al terminar se mueve
+#(rename) a su lugar en el almacenamiento por contenido
+def get_upload_session(upload_id: str) -> UploadSession:
+  upload = db.session.get(UploadSession, upload_id)
+  if upload is None or upload.user_id != session["user_id"]:
+    abort(404)
+  return upload
+
+def upload_state(upload: UploadSession):
+  return jsonify(
+    id=upload.id,
+    size=upload.size,
+    received=upload.received,
+    chunk_size=app.config["UPLOAD_CHUNK_SIZE"],
+    url=url_for("upload_chunk", upload_id=upload.id),
+  )
+
+@app.route("/books/<int:book_id>/uploads", methods=["POST"])
+def start_upload(book_id):
+  if "user_id" not in session:
+    abort(401)
+  book = Book.query.get_or_404(book_id)
+  if book.creator_user_id != session["user_id"]:
+    abort(403)
+
+  data = request.get_json(silent=True) or {}
+  filename = str(data.get("filename", ""))
+  size = data.get("size")
+  if not allowed_file(filename):
+    return jsonify(error="Formato inválido. Solo .pdf o .md"), 400
+  if not isinstance(size, int) or not 0 < size <= app.config["UPLOAD_MAX_SIZE"]:
+    return jsonify(error="Tamaño de archivo inválido"), 400
+
+  _, ext = os.path.splitext(filename.lower())
+  upload = UploadSession(
+    id=uuid.uuid4().hex,
+    user_id=session["user_id"],
+    book_id=book.id,
+    filename=filename[:255],
+    ext=ext,
+    size=size,
+    received=0,
+  )
+  db.session.add(upload)
+  db.session.commit()
+  return upload_state(upload), 201
+
+@app.route("/upload-sessions/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+  if "user_id" not in session:
+    abort(401)
+  return upload_state(get_upload_session(upload_id))
+
+@app.route("/upload-sessions/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+  if "user_id" not in session:
+    abort(401)
+  upload = get_upload_session(upload_id)
+
+  # las partes van en orden: ?offset= tiene que ser justo lo que ya llego
+  offset = request.args.get("offset", type=int)
+  length = request.content_length
+  if offset != upload.received:
+    return jsonify(error="Parte fuera de orden", received=upload.received), 409
+  if not length or offset + length > upload.size:
+    return jsonify(error="Parte de tamaño inválido", received=upload.received), 400
+
+  # se escribe en su posicion (reintentar una parte pisa los mismos bytes) verificando el checksum
+  part = blob_storage.tmp_path(f"{upload.id}.part")
+  hasher = hashlib.sha256()
+  written = 0
+  with open(part, "r+b" if os.path.exists(part) else "wb") as f:
+    f.seek(offset)
+    while chunk := request.stream.read(64 * 1024):
+      hasher.update(chunk)
+      f.write(chunk)
+      written += len(chunk)
+  expected = request.headers.get("X-Chunk-Sha256")
+  if written != length or (expected and expected.lower() != hasher.hexdigest()):
+    return jsonify(error="La parte llegó incompleta o dañada", received=upload.received), 422
+
+  # UPDATE condicional: si otra copia de la misma parte gano la carrera no se cuenta dos veces
+  uploads = UploadSession.__table__
+  moved = db.session.execute(
+    uploads.update()
+    .where(uploads.c.id == upload.id, uploads.c.received == offset)
+    .values(received=offset + written, last_update_date=func.now())
+  ).rowcount
+  db.session.commit()
+  if not moved:
+    db.session.refresh(upload)
+    return jsonify(error="Parte fuera de orden", received=upload.received), 409
+  return jsonify(received=offset + written)
+
+@app.route("/upload-sessions/<upload_id>/finalize", methods=["POST"])
+def finish_upload(upload_id):
+  if "user_id" not in session:
+    abort(401)
+  upload = get_upload_session(upload_id)
+  if upload.received != upload.size:
+    return jsonify(error="Faltan partes", received=upload.received), 409
+
+  data = request.get_json(silent=True) or {}
+  title = str(data.get("title", "")).strip()
+  if not title:
+    return jsonify(error="El título del capítulo es obligatorio"), 400
+
+  book = db.session.get(Book, upload.book_id)
+  try:
+    blob = blob_storage.import_file(blob_storage.tmp_path(f"{upload.id}.part"), upload.ext)
+  except FileNotFoundError:
+    # el .part ya no esta (lo borro uploads-expire u otra finalizacion lo tomo): se descarta la
+    # sesion y el navegador arranca una nueva
+    db.session.rollback()
+    db.session.execute(UploadSession.__table__.delete().where(UploadSession.__table__.c.id == upload_id))
+    db.session.commit()
+    return jsonify(error="La subida ya no está disponible, hay que subir el archivo de nuevo"), 409
+  db.session.delete(upload)
+  add_chapter(book, title, blob)
+  flash("Capítulo agregado", "success")
+  return jsonify(url=url_for("book_detail", book_id=book.id))
+
 #Pagina principal de un capitulo (lector de capitulo)
 @app.route("/chapters/<int:chapter_id>")
 def chapter_reader(chapter_id):
@@ -443,33 +776,221 @@ def chapter_reader(chapter_id):
   _, ext = os.path.splitext(filename.lower())
   is_md = ext == ".md"
   is_pdf = ext == ".pdf"
-  
-  md_html = None
-  if is_md:
-    path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    if not os.path.exists(path):
+
+  # la identidad del archivo (tamaño, mtime) dice si cambio el contenido
+  try:
+    key = html_cache.key_for(blob_storage.backend, filename)
+  except FileNotFoundError:
+    if is_md:
       abort(404)
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-      text = f.read()
-    try:
-      import markdown as md
-      md_html = md.markdown(text, output_format="html5", extensions=["extra", "tables", "fenced_code"])
-    except Exception:
-      md_html = f"<pre class='text'>{text}</pre>"
+    key = None
+  etag = page_etag(chapter.title, chapter.content_hash, key)
+  last_modified = datetime.fromtimestamp(key[2] / 1e9, timezone.utc) if key else None
+  cached = not_modified(etag, last_modified)
+  if cached is not None:
+    return cached
 
-  return render_template(
+  md_html = None
+  index = None
+  if is_md:
+    index = chapter_index(chapter, filename, key)
+    if index is None:
+      # sin indice (capitulo enorme sin pre-render o render incompleto): se manda de a pedazos
+      backend = blob_storage.backend
+      md_blocks = iter_rendered(backend, filename, chapter.content_hash) or render_blocks(backend, filename)
+      page = stream_template(
+        "chapter_reader.html",
+        chapter=chapter,
+        filename=filename,
+        is_md=is_md,
+        is_pdf=is_pdf,
+        md_blocks=md_blocks,
+        toc=[],
+        sections=0,
+      )
+      # sin validadores: cuando termine el render de fondo el ETag es el mismo y el navegador
+      # se quedaria con esta version
+      response = app.response_class(page)
+      response.cache_control.no_store = True
+      return response
+    # solo la primera seccion: el resto lo pide la pagina a medida que se lee
+    md_html = chapter_section(chapter, filename, key, index, 0)
+
+  page = render_template(
     "chapter_reader.html",
     chapter=chapter,
     filename=filename,
     is_md=is_md,
     is_pdf=is_pdf,
-    md_html=md_html,
+    md_blocks=[md_html] if md_html is not None else None,
+    toc=index["toc"] if index else [],
+    sections=len(index["sections"]) if index else 0,
   )
+  return with_validators(page, etag, last_modified)
+
+#Una seccion del capitulo (fragmento HTML que pide el lector)
+@app.route("/chapters/<int:chapter_id>/sections/<int:n>")
+def chapter_section_fragment(chapter_id, n):
+  if "user_id" not in session:
+    abort(401)
+
+  chapter = Chapter.query.get_or_404(chapter_id)
+  filename = chapter.content_url.split("/uploads/", 1)[-1]
+  if not filename.lower().endswith(".md"):
+    abort(404)
+  try:
+    key = html_cache.key_for(blob_storage.backend, filename)
+  except FileNotFoundError:
+    abort(404)
+
+  index = chapter_index(chapter, filename, key)
+  html = chapter_section(chapter, filename, key, index, n) if index else None
+  if html is None:
+    abort(404)
+  return html
+
+def chapter_index(chapter, filename: str, key) -> dict | None:
+  # indice de secciones y titulos (sale del cache en memoria o del .toc.json).
+  # None para capitulos enormes que todavia no se pre-renderizaron (o cuyo render no termino)
+  text = html_cache.get(key + ("index", chapter.content_hash))
+  if text is None:
+    text = read_index(blob_storage.backend, filename, chapter.content_hash)
+    if text is None:
+      if key[1] > app.config["READER_STREAM_THRESHOLD"]:
+        # enorme: no se renderiza en el request, se encarga en segundo plano y mientras se lee en streaming
+        rerender_later(chapter.id, filename)
+        return None
+      # subido antes del pre-render (o se borro el artefacto): se renderiza y queda guardado
+      chapter.content_hash = prerender(blob_storage.backend, filename)
+      db.session.commit()
+      text = read_index(blob_storage.backend, filename, chapter.content_hash)
+      if text is None:
+        # el pool no llego a tiempo: se muestra lo que haya en el artefacto
+        return None
+    html_cache.put(key + ("index", chapter.content_hash), text)
+  return json.loads(text)
+
+def rerender_later(chapter_id: int, filename: str):
+  # pre-render sin limite de tiempo en un hilo (una vez por archivo): el proximo lector ya tiene secciones
+  def job():
+    content_hash = prerender(blob_storage.backend, filename, wait=True)
+    with app.app_context():
+      db.session.execute(db.update(Chapter).where(Chapter.id == chapter_id).values(content_hash=content_hash))
+      db.session.commit()
+  render_service.background(filename, job)
 
+def chapter_section(chapter, filename: str, key, index: dict, n: int) -> str | None:
+  # las secciones populares salen de memoria sin tocar el disco
+  html = html_cache.get(key + (chapter.content_hash, n))
+  if html is None:
+    html = read_section(blob_storage.backend, filename, chapter.content_hash, index, n)
+    if html is not None:
+      html_cache.put(key + (chapter.content_hash, n), html)
+  return html
 
 
+#--------------------
+#Metricas del worker que atiende (cada proceso tiene su pool y sus caches): para el scraper, con
+#  Authorization: Bearer <METRICS_TOKEN>
+METRICS = {
+  "db-pool": db_pool.stats,
+  "html-cache": html_cache.stats,
+  "render-pool": render_service.stats,
+}
+
+@app.route("/metrics/<name>")
+def metrics(name):
+  token = app.config["METRICS_TOKEN"]
+  given = request.headers.get("Authorization", "").removeprefix("Bearer ")
+  if not token or not hmac.compare_digest(given.encode(), token.encode()) or name not in METRICS:
+    abort(404)
+  response = jsonify(METRICS[name]())
+  response.cache_control.no_store = True
+  return response
 
 
+#--------------------
+#Comandos (flask --app app <comando>)
+
+@app.cli.command("chapters-count-repair")
+def chapters_count_repair():
+  """Recalcula books.chapters_count en bloque (por si quedo desfasado)."""
+  real = (
+    db.select(func.count(Chapter.id))
+    .where(Chapter.book_id == Book.id)
+    .scalar_subquery()
+  )
+  result = db.session.execute(
+    db.update(Book)
+    .where(Book.chapters_count != real)
+    .values(chapters_count=real, last_update_date=Book.last_update_date)
+    .execution_options(synchronize_session=False)
+  )
+  db.session.commit()
+  click.echo(f"{result.rowcount} libros corregidos")
+
+@app.cli.command("chapters-render")
+@click.option("--force", is_flag=True, help="Renderiza de nuevo aunque el HTML ya exista.")
+def chapters_render(force):
+  """Pre-renderiza a HTML los capitulos .md (los subidos antes de que existiera el pre-render)."""
+  backend = blob_storage.backend
+  done = 0
+  for ch in Chapter.query.filter(Chapter.content_url.like("%.md")).order_by(Chapter.id.asc()).all():
+    filename = ch.content_url.split("/uploads/", 1)[-1]
+    if backend.stat(filename) is None:
+      continue
+    if not force and read_index(backend, filename, ch.content_hash) is not None:
+      continue
+    remove_rendered(backend, filename)
+    ch.content_hash = prerender(backend, filename, wait=True)
+    db.session.commit()
+    done += 1
+  click.echo(f"{done} capitulos renderizados")
+
+@app.cli.command("uploads-migrate")
+def uploads_migrate():
+  """Pasa los archivos subidos antes al almacenamiento por contenido (ab/cd/<sha256>)."""
+  # los archivos viejos estan en UPLOAD_FOLDER aunque el backend configurado sea otro
+  legacy = LocalStorage(app.config["UPLOAD_FOLDER"])
+  backend = blob_storage.backend
+  done = 0
+  missing = 0
+  for ch in Chapter.query.filter(Chapter.blob_sha256.is_(None)).order_by(Chapter.id.asc()).all():
+    filename = ch.content_url.split("/uploads/", 1)[-1]
+    _, ext = os.path.splitext(filename.lower())
+    try:
+      source = legacy.path(filename)
+    except FileNotFoundError:
+      source = None
+    if source is None or not os.path.exists(source):
+      missing += 1
+      continue
+    remove_rendered(legacy, filename)
+    blob = blob_storage.import_file(source, ext)
+    ch.blob = blob
+    with app.test_request_context():
+      ch.content_url = url_for("uploaded_file", filename=blob.key)
+    if ext == ".md":
+      ch.content_hash = blob.sha256 if read_index(backend, blob.key, blob.sha256) else prerender(backend, blob.key, wait=True)
+    db.session.commit()
+    done += 1
+  click.echo(f"{done} archivos migrados, {missing} no encontrados")
+
+@app.cli.command("uploads-expire")
+@click.option("--hours", default=24, show_default=True, help="Antiguedad minima sin actividad.")
+def uploads_expire(hours):
+  """Borra las subidas por partes abandonadas y sus archivos .part."""
+  # con la hora de la base, que es la que guarda last_update_date (la del servidor puede ser otra zona)
+  limit = db.session.execute(db.select(func.now())).scalar() - timedelta(hours=hours)
+  stale = UploadSession.query.filter(UploadSession.last_update_date < limit).all()
+  for upload in stale:
+    try:
+      os.remove(blob_storage.tmp_path(f"{upload.id}.part"))
+    except FileNotFoundError:
+      pass
+    db.session.delete(upload)
+  db.session.commit()
+  click.echo(f"{len(stale)} subidas vencidas")
 
 
 if __name__ == "__main__":
@@ -479,7 +1000,7 @@ if __name__ == "__main__":
 
     if not tables: 
       print("creating tables...")
-      db.create_all()
+      db.create_all(bind_key=None)  # la replica las recibe por replicacion
     else:
       print(f"all tables done")
   app.run(debug=True)
@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+#--------------------
+#Pool de conexiones de cada worker. Todo se configura con DB_POOL_* (se vuelca en
+#SQLALCHEMY_ENGINE_OPTIONS, asi que vale para el primario y la replica):
+#  DB_POOL_SIZE / DB_POOL_MAX_OVERFLOW -> conexiones fijas / extra por worker
+#  DB_POOL_TIMEOUT  -> segundos esperando una conexion libre antes de fallar
+#  DB_POOL_RECYCLE  -> segundos de vida de una conexion; menos que el wait_timeout de MySQL
+#                      para no toparse con "MySQL server has gone away"
+#  DB_POOL_PRE_PING -> prueba la conexion al sacarla del pool (las cortadas se reabren)
+#Con un servidor pre-fork (gunicorn, uwsgi) el hijo hereda los sockets del padre: despues del
+#fork se descartan sin cerrarlos (los sigue usando el padre) y cada worker abre los suyos.
+#stats() da por engine la espera para obtener una conexion y que tan lleno esta el pool.
+
+
+class MeteredQueuePool(QueuePool):
+  # QueuePool que mide cada checkout. dispose() (y el fork) arma uno nuevo con recreate():
+  # las metricas arrancan de cero
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._metrics_lock = threading.Lock()
+    self.checkouts = 0
+    self.wait_seconds = 0.0
+    self.max_wait = 0.0
+    self.slow_checkouts = 0
+    self.timeouts = 0
+    self.peak_checked_out = 0
+
+  def _do_get(self):
+    # espera por una conexion libre (o lo que tarda abrir una nueva)
+    start = time.perf_counter()
+    try:
+      connection = super()._do_get()
+    except PoolTimeout:
+      with self._metrics_lock:
+        self.timeouts += 1
+      raise
+    waited = time.perf_counter() - start
+    with self._metrics_lock:
+      self.checkouts += 1
+      self.wait_seconds += waited
+      self.max_wait = max(self.max_wait, waited)
+      self.slow_checkouts += waited >= db_pool.slow_checkout
+      self.peak_checked_out = max(self.peak_checked_out, self.checkedout())
+    return connection
+
+  def stats(self) -> dict:
+    # max_overflow -1 = sin limite: no hay saturacion que medir
+    capacity = self.size() + self._max_overflow if self._max_overflow >= 0 else 0
+    with self._metrics_lock:
+      return {
+        "size": self.size(),
+        "max_overflow": self._max_overflow,
+        "checked_out": self.checkedout(),
+        "idle": self.checkedin(),
+        "overflow": max(self.overflow(), 0),
+        "saturation": round(self.checkedout() / capacity, 3) if capacity else None,
+        "peak_checked_out": self.peak_checked_out,
+        "checkouts": self.checkouts,
+        "avg_wait_ms": round(self.wait_seconds / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+        "max_wait_ms": round(self.max_wait * 1000, 3),
+        "slow_checkouts": self.slow_checkouts,
+        "timeouts": self.timeouts,
+      }
+
+
+class DbPool:
+  def __init__(self, size: int = 5, max_overflow: int = 10, timeout: float = 10.0, recycle: int = 280,
+               pre_ping: bool = True, slow_checkout: float = 0.1):
+    self.size = size
+    self.max_overflow = max_overflow
+    self.timeout = timeout
+    self.recycle = recycle
+    self.pre_ping = pre_ping
+    self.slow_checkout = slow_checkout
+    self._apps = []
+    self._fork_hook = False
+
+  def init_app(self, app):
+    # antes de db.init_app: los engines se crean ahi con estas opciones
+    app.config.setdefault("DB_POOL_SIZE", self.size)
+    app.config.setdefault("DB_POOL_MAX_OVERFLOW", self.max_overflow)
+    app.config.setdefault("DB_POOL_TIMEOUT", self.timeout)  # segundos
+    app.config.setdefault("DB_POOL_RECYCLE", self.recycle)  # segundos
+    app.config.setdefault("DB_POOL_PRE_PING", self.pre_ping)
+    app.config.setdefault("DB_POOL_SLOW_CHECKOUT", self.slow_checkout)  # segundos
+    self.slow_checkout = app.config["DB_POOL_SLOW_CHECKOUT"]
+
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    options.setdefault("pool_pre_ping", app.config["DB_POOL_PRE_PING"])
+    options.setdefault("pool_recycle", app.config["DB_POOL_RECYCLE"])
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    # sqlite en memoria usa un pool de una sola conexion (lo pone Flask-SQLAlchemy)
+    if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+      options.setdefault("poolclass", MeteredQueuePool)
+      options.setdefault("pool_size", app.config["DB_POOL_SIZE"])
+      options.setdefault("max_overflow", app.config["DB_POOL_MAX_OVERFLOW"])
+      options.setdefault("pool_timeout", app.config["DB_POOL_TIMEOUT"])
+
+    self._apps.append(app)
+    if not self._fork_hook and hasattr(os, "register_at_fork"):
+      os.register_at_fork(after_in_child=self._after_fork)
+      self._fork_hook = True
+    app.extensions["db_pool"] = self
+
+  def _engines(self, app) -> dict:
+    with app.app_context():
+      return dict(app.extensions["sqlalchemy"].engines) if "sqlalchemy" in app.extensions else {}
+
+  def _after_fork(self):
+    # close=False: las conexiones heredadas siguen siendo del padre, no hay que cerrarlas
+    for app in self._apps:
+      for engine in self._engines(app).values():
+        engine.dispose(close=False)
+
+  def stats(self) -> dict:
+    # del worker que atiende el request: cada uno tiene su pool
+    result = {"pid": os.getpid()}
+    for key, engine in current_app.extensions["sqlalchemy"].engines.items():
+      pool = engine.pool
+      if isinstance(pool, MeteredQueuePool):
+        result[key or "primary"] = pool.stats()
+      else:
+        result[key or "primary"] = {"pool": type(pool).__name__, "status": pool.status()}
+    return result
+
+
+db_pool = DbPool()
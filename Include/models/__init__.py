@@ -1,9 +1,16 @@
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+from .routing import RoutingSession, replica_router
+
+# RoutingSession manda los SELECT de los GET a la replica si hay una (ver routing.py)
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 from .rank import Rank
 from .user import User
 from .book import Book
 from .chapter import Chapter
 from .comment import Comment
+from .chapter_terms import ChapterTerms
+from .blob import Blob, blob_key, reserve_blob
+from .upload_session import UploadSession
+from .search_tombstone import SearchTombstone
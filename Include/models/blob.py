@@ -0,0 +1,98 @@
+from . import db
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql import func
+
+
+class Blob(db.Model):
+  __tablename__ = "blobs"
+
+  # un archivo subido, guardado una sola vez por contenido (ver storage.py)
+  sha256 = db.Column(db.String(64), primary_key=True)
+  ext = db.Column(db.String(10), nullable=False)
+  size = db.Column(db.BigInteger, nullable=False)
+  # capitulos que lo usan; lo mantienen los eventos de Chapter (ver models/chapter.py)
+  refcount = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+  creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+  # Blob -> Chapters
+  chapters = db.relationship("Chapter", back_populates="blob")
+
+  @property
+  def key(self) -> str:
+    return blob_key(self.sha256, self.ext)
+
+  def __repr__(self):
+    return f"<Blob {self.sha256[:12]}{self.ext} refs={self.refcount}>"
+
+
+def blob_key(sha256: str, ext: str) -> str:
+  # ruta relativa a UPLOAD_FOLDER: ab/cd/abcd...<ext> (dos niveles para no llenar un solo directorio)
+  return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+
+
+#--------------------
+#Contador de referencias: se actualiza en la misma transaccion que el alta/baja del capitulo.
+#Los blobs que quedan en 0 se borran (fila y archivo) recien despues del commit
+def add_to_refcount(connection, sha256: str, delta: int):
+  blobs = db.metadata.tables["blobs"]
+  connection.execute(
+    blobs.update()
+    .where(blobs.c.sha256 == sha256)
+    .values(refcount=blobs.c.refcount + delta)
+  )
+
+def reserve_blob(session, sha256: str, ext: str, size: int):
+  # alta del blob si no existia (INSERT IGNORE: dos subidas del mismo archivo no chocan) + la
+  # referencia del capitulo que se va a crear, en la transaccion de ese capitulo. El UPDATE deja la
+  # fila bloqueada hasta el commit: collect() no la puede borrar (ni el archivo) mientras tanto
+  blobs = db.metadata.tables["blobs"]
+  session.execute(
+    db.insert(blobs)
+    .values(sha256=sha256, ext=ext, size=size, refcount=0)
+    .prefix_with("OR IGNORE", dialect="sqlite")
+    .prefix_with("IGNORE", dialect="mysql")
+  )
+  add_to_refcount(session, sha256, 1)
+  reserved = session.info.setdefault("reserved_blobs", {})
+  reserved[sha256] = reserved.get(sha256, 0) + 1
+
+def add_blob_reference(connection, target, sha256: str):
+  # un capitulo que apunta al blob: si reserve_blob ya conto la referencia en esta transaccion se usa esa
+  session = object_session(target)
+  reserved = session.info.get("reserved_blobs") if session is not None else None
+  if reserved and reserved.get(sha256):
+    reserved[sha256] -= 1
+  else:
+    add_to_refcount(connection, sha256, 1)
+
+def queue_blob_release(target, sha256: str):
+  session = object_session(target)
+  if session is not None:
+    session.info.setdefault("released_blobs", set()).add(sha256)
+
+@event.listens_for(db.session, "after_commit")
+def _collect_released_blobs(session):
+  released = session.info.pop("released_blobs", None)
+  if not released:
+    return
+  storage = current_app.extensions.get("blob_storage")
+  if storage is not None:
+    storage.collect(released)
+
+@event.listens_for(db.session, "before_commit")
+def _release_unused_blobs(session):
+  # reservas que ningun capitulo uso (la subida no termino en un alta): se devuelven antes del commit
+  if not session.info.get("reserved_blobs"):
+    return
+  session.flush()  # los capitulos pendientes toman sus reservas
+  for sha256, count in session.info.pop("reserved_blobs", {}).items():
+    if count:
+      add_to_refcount(session, sha256, -count)
+      session.info.setdefault("released_blobs", set()).add(sha256)
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_released_blobs(session):
+  session.info.pop("released_blobs", None)
+  session.info.pop("reserved_blobs", None)
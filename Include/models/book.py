@@ -1,9 +1,20 @@
 from . import db
+from .search_changes import queue_search_change
+from .search_tombstone import SearchTombstone
+from .cache_tags import queue_cache_invalidation
+from sqlalchemy import event, inspect
 from sqlalchemy.sql import func
 
 
 class Book(db.Model):
   __tablename__ = "books"
+  __table_args__ = (
+    # orden "Cantidad de capitulos" de /search
+    db.Index("ix_books_chapters_count_title", db.text("chapters_count DESC"), "title"),
+    # libros de un usuario por fecha (my_books, home). El simple de creator_user_id queda para
+    # el orden "Autor A-Z" (por autor y despues por id, que va implicito al final del indice)
+    db.Index("ix_books_creator_user_id_creation_date", "creator_user_id", "creation_date"),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   creator_user_id = db.Column(
@@ -15,8 +26,10 @@ class Book(db.Model):
   title = db.Column(db.String(200), nullable=False)
   subtitle = db.Column(db.String(200))
   description = db.Column(db.Text)
-  creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
-  last_update_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+  creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+  last_update_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False, index=True)
+  # lo mantienen los eventos de Chapter (ver models/chapter.py); `flask chapters-count-repair` lo recalcula
+  chapters_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
   # FK relations
   creator = db.relationship("User", back_populates="books")
@@ -40,4 +53,35 @@ class Book(db.Model):
   )
 
   def __repr__(self):
-    return f"<Book {self.title}>"
\ No newline at end of file
+    return f"<Book {self.title}>"
+
+
+#--------------------
+#Mantenimiento incremental del indice de busqueda
+SEARCH_FIELDS = ("title", "subtitle", "description")
+
+@event.listens_for(Book, "after_insert")
+def _book_inserted(mapper, connection, target):
+  queue_search_change(target, "book_search", target.id, {f: getattr(target, f) for f in SEARCH_FIELDS})
+
+@event.listens_for(Book, "after_update")
+def _book_updated(mapper, connection, target):
+  # new_chapter solo toca last_update_date: no hace falta reindexar
+  state = inspect(target)
+  if any(state.attrs[f].history.has_changes() for f in SEARCH_FIELDS):
+    queue_search_change(target, "book_search", target.id, {f: getattr(target, f) for f in SEARCH_FIELDS})
+
+@event.listens_for(Book, "after_delete")
+def _book_deleted(mapper, connection, target):
+  queue_search_change(target, "book_search", target.id, None)
+  # en la misma transaccion: los otros workers se enteran de la baja en su sync()
+  connection.execute(SearchTombstone.__table__.insert().values(index_name="books", doc_id=target.id))
+
+
+#--------------------
+#Cualquier alta/baja/edicion de un libro puede cambiar los listados cacheados
+@event.listens_for(Book, "after_insert")
+@event.listens_for(Book, "after_update")
+@event.listens_for(Book, "after_delete")
+def _book_changed(mapper, connection, target):
+  queue_cache_invalidation(target, "books")
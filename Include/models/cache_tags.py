@@ -0,0 +1,26 @@
+from . import db
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+
+#--------------------
+#Invalidacion del cache de resultados: los tags tocados se juntan en la sesion durante el flush
+#y se invalidan recien en after_commit (un rollback los descarta), igual que search_changes
+def queue_cache_invalidation(target, *tags: str):
+  session = object_session(target)
+  if session is not None:
+    session.info.setdefault("cache_tags", set()).update(tags)
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_cache_tags(session):
+  tags = session.info.pop("cache_tags", None)
+  if not tags:
+    return
+  cache = current_app.extensions.get("result_cache")
+  if cache is not None:
+    cache.invalidate(*tags)
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_cache_tags(session):
+  session.info.pop("cache_tags", None)
@@ -1,22 +1,90 @@
 from . import db
+from .cache_tags import queue_cache_invalidation
+from .blob import add_blob_reference, add_to_refcount, queue_blob_release
+from sqlalchemy import event, inspect
 from sqlalchemy.sql import func
 
 
 class Chapter(db.Model):
   __tablename__ = "chapters"
+  __table_args__ = (
+    # capitulos de un libro en orden (book_detail, paginado por id); tambien sirve de indice de la FK
+    db.Index("ix_chapters_book_id_id", "book_id", "id"),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   book_id = db.Column(
     db.Integer,
     db.ForeignKey("books.id", ondelete="CASCADE"),
     nullable=False,
-    index=True,
   )
   title = db.Column(db.String(200), nullable=False)
   content_url = db.Column(db.String(500), nullable=False)
+  # archivo en el almacenamiento por contenido (None en capitulos subidos antes, ver uploads-migrate)
+  blob_sha256 = db.Column(db.String(64), db.ForeignKey("blobs.sha256"), index=True)
+  # sha256 del .md ya renderizado (ver rendering.py); None en pdf o si falta pre-renderizar
+  content_hash = db.Column(db.String(64))
 
-  # FK relation
+  # FK relations
   book = db.relationship("Book", back_populates="chapters")
+  blob = db.relationship("Blob", back_populates="chapters")
+
+  # Chapter -> ChapterTerms (indice de busqueda del contenido)
+  search_terms = db.relationship(
+    "ChapterTerms",
+    back_populates="chapter",
+    uselist=False,
+    cascade="all, delete-orphan",
+    passive_deletes=True,
+  )
 
   def __repr__(self):
-    return f"<Chapter {self.title} of Book#{self.book_id}>"
\ No newline at end of file
+    return f"<Chapter {self.title} of Book#{self.book_id}>"
+
+
+#--------------------
+#Contador de capitulos en books: se actualiza en la misma transaccion que el alta/baja
+def _add_to_chapters_count(connection, book_id: int, delta: int):
+  books = db.metadata.tables["books"]
+  connection.execute(
+    books.update()
+    .where(books.c.id == book_id)
+    # sin tocar last_update_date (el onupdate de la columna lo pisaria)
+    .values(chapters_count=books.c.chapters_count + delta, last_update_date=books.c.last_update_date)
+  )
+
+@event.listens_for(Chapter, "after_insert")
+def _chapter_inserted(mapper, connection, target):
+  _add_to_chapters_count(connection, target.book_id, 1)
+  queue_cache_invalidation(target, "chapters")
+
+@event.listens_for(Chapter, "after_delete")
+def _chapter_deleted(mapper, connection, target):
+  _add_to_chapters_count(connection, target.book_id, -1)
+  queue_cache_invalidation(target, "chapters")
+
+
+#--------------------
+#Referencias a los blobs (un mismo archivo puede estar en varios capitulos)
+@event.listens_for(Chapter, "after_insert")
+def _chapter_blob_added(mapper, connection, target):
+  if target.blob_sha256:
+    add_blob_reference(connection, target, target.blob_sha256)
+
+@event.listens_for(Chapter, "after_update")
+def _chapter_blob_changed(mapper, connection, target):
+  # uploads-migrate pasa capitulos viejos al almacenamiento por contenido
+  history = inspect(target).attrs.blob_sha256.history
+  for sha256 in history.deleted or ():
+    if sha256:
+      add_to_refcount(connection, sha256, -1)
+      queue_blob_release(target, sha256)
+  for sha256 in history.added or ():
+    if sha256:
+      add_blob_reference(connection, target, sha256)
+
+@event.listens_for(Chapter, "after_delete")
+def _chapter_blob_removed(mapper, connection, target):
+  if target.blob_sha256:
+    add_to_refcount(connection, target.blob_sha256, -1)
+    queue_blob_release(target, target.blob_sha256)
@@ -0,0 +1,34 @@
+import json
+
+from . import db
+from .search_changes import queue_search_change
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql
+
+# textos largos: en MySQL TEXT llega a 64 KB
+LongText = db.Text().with_variant(mysql.LONGTEXT(), "mysql")
+
+
+class ChapterTerms(db.Model):
+  __tablename__ = "chapter_terms"
+
+  # se calcula una sola vez al subir el capitulo, asi buscar nunca abre archivos
+  chapter_id = db.Column(
+    db.Integer,
+    db.ForeignKey("chapters.id", ondelete="CASCADE"),
+    primary_key=True,
+  )
+  terms = db.Column(LongText, nullable=False)  # {"termino": [frecuencia en titulo, frecuencia en texto]}
+  snippets = db.Column(LongText, nullable=False)  # {"termino": "fragmento donde aparece por primera vez"}
+
+  # FK relation
+  chapter = db.relationship("Chapter", back_populates="search_terms")
+
+  def __repr__(self):
+    return f"<ChapterTerms of Chapter#{self.chapter_id}>"
+
+
+@event.listens_for(ChapterTerms, "after_insert")
+@event.listens_for(ChapterTerms, "after_update")
+def _chapter_terms_saved(mapper, connection, target):
+  queue_search_change(target, "chapter_search", target.chapter_id, json.loads(target.terms))
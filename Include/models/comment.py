@@ -4,6 +4,10 @@ from sqlalchemy.sql import func
 
 class Comment(db.Model):
   __tablename__ = "comments"
+  __table_args__ = (
+    # comentarios de un libro, los mas nuevos primero (paginado por id); tambien sirve de indice de la FK
+    db.Index("ix_comments_book_id_id", "book_id", "id"),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   commentator_user_id = db.Column(
@@ -16,7 +20,6 @@ class Comment(db.Model):
     db.Integer,
     db.ForeignKey("books.id", ondelete="CASCADE"),
     nullable=False,
-    index=True,
   )
   content = db.Column(db.Text, nullable=False)
   creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -0,0 +1,143 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request, session as user_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+#--------------------
+#Lecturas a la replica: los SELECT de los requests GET/HEAD van al bind "replica" (si hay uno
+#configurado, SQLALCHEMY_BINDS["replica"]); todo lo demas va al primario. Se lee del primario:
+#  - cualquier escritura (flush, UPDATE/DELETE sueltos) y todo lo que sigue en ese request
+#  - los requests de un usuario durante REPLICA_STICKY_SECONDS despues de su ultimo commit
+#    (ve enseguida su comentario o capitulo nuevo aunque la replica venga atrasada)
+#  - cuando la replica no responde o viene mas atrasada que REPLICA_MAX_LAG (se prueba cada
+#    REPLICA_HEALTH_INTERVAL segundos y ante un error de conexion)
+#Fuera de un request (comandos) todo va al primario, y dentro de primary_only() tambien.
+
+_STICKY_KEY = "db_primary_until"
+
+
+class ReplicaRouter:
+  def __init__(self, sticky_seconds: float = 5.0, health_interval: float = 5.0, max_lag: float = 10.0):
+    self.sticky_seconds = sticky_seconds
+    self.health_interval = health_interval
+    self.max_lag = max_lag
+    self.engine = None
+    self.healthy = False
+    self._checked_at = float("-inf")
+    self._lock = threading.Lock()
+    self._forced = threading.local()
+    self.replica_reads = 0
+    self.primary_reads = 0
+    self.probe_failures = 0
+
+  def init_app(self, app):
+    app.config.setdefault("REPLICA_STICKY_SECONDS", self.sticky_seconds)
+    app.config.setdefault("REPLICA_HEALTH_INTERVAL", self.health_interval)
+    app.config.setdefault("REPLICA_MAX_LAG", self.max_lag)  # segundos (solo MySQL)
+    self.sticky_seconds = app.config["REPLICA_STICKY_SECONDS"]
+    self.health_interval = app.config["REPLICA_HEALTH_INTERVAL"]
+    self.max_lag = app.config["REPLICA_MAX_LAG"]
+    with app.app_context():
+      self.engine = app.extensions["sqlalchemy"].engines.get("replica")
+    if self.engine is not None:
+      event.listen(self.engine, "handle_error", self._connection_error)
+    app.extensions["replica_router"] = self
+
+  def read_engine(self):
+    # el engine para un SELECT, o None si tiene que ir al primario
+    if self.engine is None or not has_request_context() or request.method not in ("GET", "HEAD"):
+      return None
+    if getattr(self._forced, "primary", False):
+      return None
+    if user_session.get(_STICKY_KEY, 0) > time.time() or not self._is_healthy():
+      self.primary_reads += 1
+      return None
+    self.replica_reads += 1
+    return self.engine
+
+  @contextmanager
+  def primary_only(self):
+    # los requests de este hilo leen del primario (db-plan-check: mide las consultas ahi)
+    previous = getattr(self._forced, "primary", False)
+    self._forced.primary = True
+    try:
+      yield
+    finally:
+      self._forced.primary = previous
+
+  def stick(self):
+    # despues de un commit del usuario: sus proximos requests leen del primario un rato
+    if self.engine is not None and has_request_context():
+      user_session[_STICKY_KEY] = time.time() + self.sticky_seconds
+
+  def _is_healthy(self) -> bool:
+    # un solo hilo prueba por vez; los demas usan el ultimo resultado
+    if time.monotonic() - self._checked_at < self.health_interval:
+      return self.healthy
+    if not self._lock.acquire(blocking=False):
+      return self.healthy
+    try:
+      self._checked_at = time.monotonic()
+      self.healthy = self._probe()
+      if not self.healthy:
+        self.probe_failures += 1
+    finally:
+      self._lock.release()
+    return self.healthy
+
+  def _probe(self) -> bool:
+    try:
+      with self.engine.connect() as connection:
+        connection.exec_driver_sql("SELECT 1")
+        if connection.dialect.name == "mysql":
+          row = connection.exec_driver_sql("SHOW REPLICA STATUS").mappings().first()
+          if row is not None:
+            lag = row.get("Seconds_Behind_Source")
+            return lag is not None and lag <= self.max_lag
+    except Exception:
+      return False
+    return True
+
+  def _connection_error(self, context):
+    # se cayo la conexion: al primario hasta la proxima prueba
+    if context.is_disconnect or context.connection is None:
+      self.healthy = False
+      self._checked_at = time.monotonic()
+
+  def stats(self) -> dict:
+    return {
+      "configured": self.engine is not None,
+      "healthy": self.healthy,
+      "replica_reads": self.replica_reads,
+      "primary_reads": self.primary_reads,
+      "probe_failures": self.probe_failures,
+    }
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+  def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+    if bind is None:
+      if clause is not None and clause.is_select and not self.info.get("wrote"):
+        engine = replica_router.read_engine()
+        if engine is not None:
+          return engine
+      else:
+        # flush, UPDATE/DELETE sueltos o session.connection(): desde aca todo al primario
+        self.info["wrote"] = True
+    return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _stick_to_primary(session):
+  if session.info.pop("wrote", False):
+    replica_router.stick()
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_writes(session):
+  session.info.pop("wrote", None)
@@ -0,0 +1,27 @@
+from . import db
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+
+#--------------------
+#Cambios para los indices de busqueda: se juntan en la sesion durante el flush
+#y se aplican recien en after_commit (un rollback los descarta)
+def queue_search_change(target, extension: str, doc_id: int, values):
+  session = object_session(target)
+  if session is not None:
+    session.info.setdefault("search_changes", {}).setdefault(extension, {})[doc_id] = values
+
+@event.listens_for(db.session, "after_commit")
+def _apply_search_changes(session):
+  changes = session.info.pop("search_changes", None)
+  if not changes:
+    return
+  for extension, docs in changes.items():
+    search = current_app.extensions.get(extension)
+    if search is not None:
+      search.apply_changes(docs)
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_search_changes(session):
+  session.info.pop("search_changes", None)
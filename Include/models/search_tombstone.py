@@ -0,0 +1,16 @@
+from . import db
+from sqlalchemy.sql import func
+
+
+class SearchTombstone(db.Model):
+  __tablename__ = "search_tombstones"
+
+  # baja de un documento de un indice de busqueda. Las altas y ediciones de otros workers llegan
+  # por last_update_date; las bajas no dejan fila, asi que se anotan aca (ver search/engine.py)
+  id = db.Column(db.Integer, primary_key=True)
+  index_name = db.Column(db.String(20), nullable=False)
+  doc_id = db.Column(db.Integer, nullable=False)
+  creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+
+  def __repr__(self):
+    return f"<SearchTombstone {self.index_name} {self.doc_id}>"
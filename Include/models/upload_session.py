@@ -0,0 +1,31 @@
+from . import db
+from sqlalchemy.sql import func
+
+
+class UploadSession(db.Model):
+  __tablename__ = "upload_sessions"
+
+  # subida por partes de un capitulo: las partes se escriben en UPLOAD_FOLDER/tmp/<id>.part
+  # y al terminar el archivo pasa entero al almacenamiento por contenido (ver app.py)
+  id = db.Column(db.String(32), primary_key=True)
+  user_id = db.Column(
+    db.Integer,
+    db.ForeignKey("users.id", ondelete="CASCADE"),
+    nullable=False,
+    index=True,
+  )
+  book_id = db.Column(
+    db.Integer,
+    db.ForeignKey("books.id", ondelete="CASCADE"),
+    nullable=False,
+    index=True,
+  )
+  filename = db.Column(db.String(255), nullable=False)
+  ext = db.Column(db.String(10), nullable=False)
+  size = db.Column(db.BigInteger, nullable=False)
+  received = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")  # bytes confirmados
+  creation_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+  last_update_date = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+  def __repr__(self):
+    return f"<UploadSession {self.id} {self.received}/{self.size}>"
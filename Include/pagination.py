@@ -0,0 +1,153 @@
+from datetime import datetime
+from operator import attrgetter
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import and_, or_
+
+#--------------------
+#Paginacion por cursor (keyset): en vez de OFFSET se pide "lo que viene despues de la ultima fila",
+#asi la pagina 500 cuesta lo mismo que la 1 y no hace falta el COUNT.
+#Los cursores van firmados con la SECRET_KEY para que no se puedan armar a mano.
+
+
+class Page:
+  def __init__(self, items, cursor=None, next_cursor=None, prev_cursor=None):
+    self.items = items
+    self.cursor = cursor  # el que se uso para llegar aca (para volver a la misma pagina)
+    self.next_cursor = next_cursor
+    self.prev_cursor = prev_cursor
+
+  @property
+  def has_next(self) -> bool:
+    return self.next_cursor is not None
+
+  @property
+  def has_prev(self) -> bool:
+    return self.prev_cursor is not None
+
+  def __iter__(self):
+    return iter(self.items)
+
+  def __len__(self):
+    return len(self.items)
+
+
+class SortKey:
+  # columna del orden + como leer su valor de una fila
+  def __init__(self, column, desc: bool = False, get=None):
+    self.column = column
+    self.desc = desc
+    self.get = get or attrgetter(column.key)
+
+
+def _serializer():
+  return URLSafeSerializer(current_app.secret_key, salt="bksh-cursor")
+
+
+def _dump(value):
+  if isinstance(value, datetime):
+    return {"dt": value.isoformat()}
+  return value
+
+
+def _load(value):
+  if isinstance(value, dict) and "dt" in value:
+    return datetime.fromisoformat(value["dt"])
+  return value
+
+
+def encode_cursor(scope: str, **data) -> str:
+  return _serializer().dumps({"s": scope, **data})
+
+
+def decode_cursor(token: str | None, scope: str) -> dict | None:
+  # None si no hay cursor, esta adulterado o es de otro listado/orden
+  if not token:
+    return None
+  try:
+    data = _serializer().loads(token)
+  except BadSignature:
+    return None
+  if not isinstance(data, dict) or data.get("s") != scope:
+    return None
+  return data
+
+
+def _beyond(keys: list[SortKey], values: list, backwards: bool):
+  # filas que vienen despues de values en el orden (o antes si backwards):
+  # (a > x) OR (a = x AND b > y) OR ...
+  clauses = []
+  for i, key in enumerate(keys):
+    before = key.desc != backwards
+    cmp = key.column < values[i] if before else key.column > values[i]
+    clauses.append(and_(*[keys[j].column == values[j] for j in range(i)], cmp))
+  return or_(*clauses)
+
+
+def _scan(query, keys: list[SortKey], order, backwards: bool, keep: set, wanted: int, batch: int) -> list:
+  # las primeras `wanted` filas (en orden) cuyo id esta en keep, leyendo de a `batch` filas.
+  # Para conjuntos de ids grandes: con muchos coincidentes alcanza con leer pocas filas
+  rows = []
+  page = query
+  while True:
+    chunk = page.order_by(*order).limit(batch).all()
+    rows.extend(row for row in chunk if row.id in keep)
+    if len(rows) >= wanted or len(chunk) < batch:
+      return rows[:wanted]
+    page = query.filter(_beyond(keys, [key.get(chunk[-1]) for key in keys], backwards))
+
+
+def keyset_paginate(query, keys: list[SortKey], cursor: str | None, per_page: int, scope: str,
+                    keep: set | None = None, batch: int = 500) -> Page:
+  # keys tiene que terminar en una columna unica (id) para que el orden sea total.
+  # keep: ids permitidos, filtrados en memoria en vez de con un IN (...) enorme (ver BookSearch.restrict)
+  data = decode_cursor(cursor, scope)
+  backwards = bool(data) and data.get("d") == "p"
+
+  if data:
+    values = [_load(v) for v in data.get("k", [])]
+    if len(values) == len(keys):
+      query = query.filter(_beyond(keys, values, backwards))
+    else:
+      data = None
+      backwards = False
+
+  order = []
+  for key in keys:
+    desc = key.desc != backwards
+    order.append(key.column.desc() if desc else key.column.asc())
+  if keep is None:
+    rows = query.order_by(*order).limit(per_page + 1).all()
+  else:
+    rows = _scan(query, keys, order, backwards, keep, per_page + 1, batch)
+
+  more = len(rows) > per_page
+  rows = rows[:per_page]
+  if backwards:
+    rows.reverse()
+
+  def cursor_for(row, direction):
+    return encode_cursor(scope, d=direction, k=[_dump(key.get(row)) for key in keys])
+
+  next_cursor = prev_cursor = None
+  if rows:
+    # yendo hacia adelante, "more" dice si hay siguiente; yendo hacia atras, si hay anterior
+    if (more and not backwards) or backwards:
+      next_cursor = cursor_for(rows[-1], "n")
+    if (more and backwards) or (data and not backwards):
+      prev_cursor = cursor_for(rows[0], "p")
+  return Page(rows, cursor=cursor if data else None, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def offset_page(load, cursor: str | None, per_page: int, scope: str) -> Page:
+  # para listas que ya vienen ordenadas en memoria (relevancia): el cursor guarda la posicion.
+  # load(offset, limit) devuelve las filas de esa ventana
+  data = decode_cursor(cursor, scope)
+  offset = max(int(data.get("o", 0)), 0) if data else 0
+  rows = load(offset, per_page + 1)
+  more = len(rows) > per_page
+  rows = rows[:per_page]
+  next_cursor = encode_cursor(scope, o=offset + per_page) if more else None
+  prev_cursor = encode_cursor(scope, o=max(offset - per_page, 0)) if offset > 0 else None
+  return Page(rows, cursor=cursor if data else None, next_cursor=next_cursor, prev_cursor=prev_cursor)
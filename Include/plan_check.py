@@ -0,0 +1,210 @@
+import re
+from urllib.parse import urlparse
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, func
+
+from models import db, Book, Comment, replica_router
+from result_cache import result_cache
+
+#--------------------
+#Chequeo de planes: recorre las rutas calientes logueado como un usuario real, junta el SQL que
+#ejecuta cada una (y su pagina siguiente) y le pide EXPLAIN a la base. Falla si alguna consulta
+#recorre una tabla entera o tiene que ordenar aparte (filesort / temp b-tree).
+#Los planes dependen de los datos: correrlo contra una base con volumen (staging) o con --seed.
+#  flask --app app db-plan-check [--seed 20000]
+
+# tablas chicas por naturaleza: recorrerlas enteras no es un problema
+SMALL_TABLES = {"ranks"}
+
+_SQLITE_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+_NEXT_RE = re.compile(r'(?:href|data-fragment-url)="([^"#]*(?:[?&]|&amp;)(?:cursor|comments)=[^"]+)"')
+
+
+def hot_routes(book_id: int) -> list[str]:
+  return [
+    "/",
+    "/my-books",
+    f"/books/{book_id}",
+    f"/books/{book_id}/comments",
+    "/search",
+    "/search?sort=created_desc",
+    "/search?sort=chapters_desc",
+    "/search?sort=creator_az",
+  ]
+
+
+def capture(user_id: int, urls: list[str]) -> list[tuple[str, str, tuple]]:
+  # (ruta, sql, parametros) de cada SELECT, sin cache de resultados de por medio.
+  # De cada pagina se sigue tambien el primer link a la pagina siguiente (consulta con cursor).
+  # Los GET leen del primario: es el engine que se escucha y donde se hace el EXPLAIN
+  captured = []
+  current = [None]
+
+  def listener(conn, cursor, statement, parameters, context, executemany):
+    if not executemany and statement.lstrip().upper().startswith("SELECT"):
+      captured.append((current[0], statement, parameters))
+
+  client = current_app.test_client()
+  with client.session_transaction() as s:
+    s["user_id"] = user_id
+  event.listen(db.engine, "before_cursor_execute", listener)
+  try:
+    pending = list(urls)
+    seen = set()
+    while pending:
+      url = pending.pop(0)
+      if url in seen:
+        continue
+      seen.add(url)
+      result_cache.clear()
+      current[0] = url
+      with replica_router.primary_only():
+        response = client.get(url)
+      if response.status_code != 200:
+        raise click.ClickException(f"{url} devolvio {response.status_code}")
+      if url in urls:
+        path = urlparse(url).path
+        for link in _NEXT_RE.findall(response.get_data(as_text=True)):
+          link = link.replace("&amp;", "&")
+          if urlparse(link).path == path:
+            pending.append(link)
+            break
+  finally:
+    event.remove(db.engine, "before_cursor_execute", listener)
+  return captured
+
+
+def explain(connection, statement: str, parameters) -> list[tuple[str, str]]:
+  # (linea del plan, problema o "")
+  plan = []
+  if connection.dialect.name == "sqlite":
+    for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+      detail = row[3]
+      scan = _SQLITE_SCAN_RE.match(detail)
+      problem = ""
+      if scan and scan.group(1) not in SMALL_TABLES:
+        problem = "recorre la tabla entera"
+      elif "TEMP B-TREE FOR" in detail and "ORDER BY" in detail:
+        problem = "ordena aparte (temp b-tree)"
+      plan.append((detail, problem))
+  else:
+    for row in connection.exec_driver_sql("EXPLAIN " + statement, parameters).mappings():
+      extra = row.get("Extra") or ""
+      problem = ""
+      if row.get("type") == "ALL" and row.get("table") not in SMALL_TABLES:
+        problem = "recorre la tabla entera"
+      elif "filesort" in extra:
+        problem = "ordena aparte (filesort)"
+      plan.append((f"{row.get('table')} type={row.get('type')} key={row.get('key')} {extra}".strip(), problem))
+  return plan
+
+
+#--------------------
+#Datos de prueba para --seed: se insertan sin pasar por el ORM (sin eventos ni indices de busqueda)
+#y se borran al terminar
+def seed(size: int) -> tuple[int, int]:
+  users = db.metadata.tables["users"]
+  books = db.metadata.tables["books"]
+  chapters = db.metadata.tables["chapters"]
+  comments = db.metadata.tables["comments"]
+  rank_id = db.session.execute(db.select(func.min(db.metadata.tables["ranks"].c.id))).scalar()
+  if rank_id is None:
+    raise click.ClickException("no hay ranks: cargar static/sql/ranks.sql")
+
+  user_ids = []
+  for i in range(10):
+    user_ids.append(db.session.execute(users.insert().values(
+      username=f"plan-check-{i}", email=f"plan-check-{i}@example.invalid", password="!", rank_id=rank_id,
+    )).inserted_primary_key[0])
+  db.session.execute(books.insert(), [
+    {"creator_user_id": user_ids[i % len(user_ids)], "title": f"plan check {i}", "chapters_count": 0}
+    for i in range(size)
+  ])
+  book_id = db.session.execute(
+    db.select(func.max(books.c.id)).where(books.c.creator_user_id == user_ids[0])
+  ).scalar()
+  extra = max(size // 10, 50)
+  db.session.execute(chapters.insert(), [
+    {"book_id": book_id, "title": f"capitulo {i}", "content_url": "/uploads/plan-check.pdf"} for i in range(extra)
+  ])
+  db.session.execute(books.update().where(books.c.id == book_id).values(chapters_count=extra))
+  db.session.execute(comments.insert(), [
+    {"book_id": book_id, "commentator_user_id": user_ids[i % len(user_ids)], "content": f"comentario {i}"}
+    for i in range(extra)
+  ])
+  db.session.commit()
+  return user_ids[0], book_id
+
+
+def unseed():
+  users = db.metadata.tables["users"]
+  books = db.metadata.tables["books"]
+  seeded_users = db.select(users.c.id).where(users.c.username.like("plan-check-%"))
+  seeded_books = db.select(books.c.id).where(books.c.creator_user_id.in_(seeded_users))
+  for name in ("comments", "chapters"):
+    table = db.metadata.tables[name]
+    db.session.execute(table.delete().where(table.c.book_id.in_(seeded_books)))
+  db.session.execute(books.delete().where(books.c.creator_user_id.in_(seeded_users)))
+  db.session.execute(users.delete().where(users.c.username.like("plan-check-%")))
+  db.session.commit()
+
+
+def analyze():
+  # estadisticas al dia para que el optimizador elija como en produccion
+  if db.engine.dialect.name == "sqlite":
+    db.session.execute(db.text("ANALYZE"))
+  else:
+    db.session.execute(db.text("ANALYZE TABLE users, books, chapters, comments"))
+  db.session.commit()
+
+
+@click.command("db-plan-check")
+@click.option("--seed", "seed_size", default=0, help="Carga N libros de prueba (y los borra al terminar).")
+@click.option("--verbose", "-v", is_flag=True, help="Muestra el plan de todas las consultas, no solo las que fallan.")
+@with_appcontext
+def plan_check_command(seed_size, verbose):
+  """EXPLAIN de las consultas de las rutas calientes: falla si alguna recorre una tabla o hace filesort."""
+  if seed_size:
+    unseed()
+    user_id, book_id = seed(seed_size)
+  else:
+    # el usuario con mas libros y el libro con mas comentarios: las paginas mas pesadas
+    user_id = db.session.execute(
+      db.select(Book.creator_user_id).group_by(Book.creator_user_id).order_by(func.count().desc()).limit(1)
+    ).scalar()
+    book_id = db.session.execute(
+      db.select(Book.id).outerjoin(Comment).group_by(Book.id).order_by(func.count(Comment.id).desc()).limit(1)
+    ).scalar()
+    if user_id is None or book_id is None:
+      raise click.ClickException("la base no tiene libros: usar --seed N")
+
+  try:
+    analyze()
+    captured = capture(user_id, hot_routes(book_id))
+    if not captured:
+      raise click.ClickException("no se capturo ninguna consulta: las rutas no llegaron a la base")
+    failures = 0
+    checked = set()
+    with db.engine.connect() as connection:
+      for url, statement, parameters in captured:
+        if statement in checked:
+          continue
+        checked.add(statement)
+        plan = explain(connection, statement, parameters)
+        bad = [problem for _, problem in plan if problem]
+        failures += bool(bad)
+        if bad or verbose:
+          click.echo(f"{'FALLA' if bad else 'ok'}  {url}")
+          click.echo("  " + " ".join(statement.split())[:300])
+          for line, problem in plan:
+            click.echo(f"    {line}" + (f"  <- {problem}" if problem else ""))
+  finally:
+    if seed_size:
+      unseed()
+
+  click.echo(f"{len(checked)} consultas revisadas, {failures} con problemas")
+  if failures:
+    raise click.exceptions.Exit(1)
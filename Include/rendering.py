@@ -0,0 +1,484 @@
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+from markupsafe import escape
+
+from search.extract import clean_markdown_line
+from search.text import tokenize
+
+#--------------------
+#Render de capitulos .md: se hace una sola vez al subir el archivo y el HTML queda al lado
+#del original (en el mismo backend de storage) como <archivo>.<hash>.html. El hash (sha256 del .md) se guarda en Chapter.content_hash,
+#asi si el archivo cambia el artefacto viejo no se usa.
+#El HTML se arma por secciones cortadas en los titulos; <archivo>.<hash>.toc.json guarda donde
+#empieza cada seccion dentro del .html y el indice de titulos, asi el lector trae solo la que muestra.
+#Si se cambian las extensiones de markdown: flask --app app chapters-render --force
+
+MARKDOWN_EXTENSIONS = ["extra", "tables", "fenced_code"]
+# cada seccion junta al menos SECTION_BYTES de markdown y corta en el siguiente titulo
+SECTION_BYTES = 64 * 1024
+# sin titulos a la vista se corta igual en una linea en blanco: un capitulo de 15 mb
+# nunca esta entero en memoria
+RENDER_BLOCK_BYTES = 256 * 1024
+
+_HEADING_RE = re.compile(r"^(#{1,6})[ \t]+(.+?)(?:[ \t]+#+)?[ \t\r]*$")
+
+_local = threading.local()
+
+
+def _markdown():
+  # armar el pipeline de extensiones es lo caro: una instancia por hilo y reset() entre usos
+  converter = getattr(_local, "markdown", None)
+  if converter is None:
+    import markdown as md
+    converter = _local.markdown = md.Markdown(output_format="html5", extensions=MARKDOWN_EXTENSIONS)
+  return converter
+
+
+def render_markdown(text: str) -> str:
+  try:
+    return _markdown().reset().convert(text)
+  except Exception:
+    return plain_html(text)
+
+
+def plain_html(text: str) -> str:
+  return f"<pre class='text'>{escape(text)}</pre>"
+
+
+#--------------------
+#markdown es Python puro: renderizar un capitulo grande en el hilo del request tiene el GIL
+#y frena a todos los demas requests del worker. Los bloques grandes van a un pool de procesos;
+#los chicos se siguen haciendo en linea (mandarlos al pool cuesta mas que renderizarlos)
+class RenderService:
+  def __init__(self, workers: int = 2, threshold: int = 32 * 1024, timeout: float = 20.0):
+    self.workers = workers
+    self.threshold = threshold
+    self.timeout = timeout
+    self._pool = None
+    self._pid = None
+    self._lock = threading.Lock()
+    self.inline = 0
+    self.submitted = 0
+    self.completed = 0
+    self.timeouts = 0
+    self.errors = 0
+    self.restarts = 0
+    self.pending = 0
+    self.busy_seconds = 0.0
+    self._background: set[str] = set()
+    self.background_jobs = 0
+    self.background_errors = 0
+
+  def init_app(self, app):
+    app.config.setdefault("RENDER_POOL_WORKERS", self.workers)  # 0 = siempre en linea
+    app.config.setdefault("RENDER_POOL_THRESHOLD", self.threshold)  # caracteres de markdown
+    app.config.setdefault("RENDER_POOL_TIMEOUT", self.timeout)  # segundos
+    self.workers = app.config["RENDER_POOL_WORKERS"]
+    self.threshold = app.config["RENDER_POOL_THRESHOLD"]
+    self.timeout = app.config["RENDER_POOL_TIMEOUT"]
+    app.extensions["render_service"] = self
+
+  def _executor(self) -> ProcessPoolExecutor:
+    # se crea al primer uso y de nuevo si el proceso se forkeo (cada worker tiene el suyo).
+    # spawn y no fork: forkear un servidor con hilos puede dejar locks tomados en el hijo
+    with self._lock:
+      if self._pool is None or self._pid != os.getpid():
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self._pid = os.getpid()
+      return self._pool
+
+  def _replace(self, pool: ProcessPoolExecutor):
+    # saca el pool de servicio (si nadie lo hizo ya) y termina sus procesos: shutdown() no corta
+    # lo que esta corriendo. Las otras tareas en curso fallan y esos pedidos renderizan en linea
+    with self._lock:
+      if self._pool is not pool:
+        return
+      self._pool = None
+      self.restarts += 1
+    processes = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+      process.terminate()
+
+  def render(self, text: str, wait: bool = False) -> tuple[str, bool]:
+    # (html, ok). Si el pool no responde a tiempo se devuelve el texto escapado en <pre> y ok=False.
+    # wait=True espera lo que haga falta (comandos, donde no hay un request esperando)
+    if self.workers <= 0 or len(text) < self.threshold:
+      with self._lock:
+        self.inline += 1
+      return render_markdown(text), True
+
+    with self._lock:
+      self.submitted += 1
+      self.pending += 1
+    started = time.perf_counter()
+    pool = self._executor()
+    try:
+      future = pool.submit(render_markdown, text)
+      html = future.result(timeout=None if wait else self.timeout)
+    except FutureTimeout:
+      with self._lock:
+        self.timeouts += 1
+      # cancel() solo saca tareas que no arrancaron: si ya corre, ocupa un proceso hasta terminar
+      if not future.cancel():
+        self._replace(pool)
+      return plain_html(text), False
+    except Exception:
+      # pool roto (un proceso murio): se descarta y el proximo pedido arma otro
+      with self._lock:
+        self.errors += 1
+      self._replace(pool)
+      return render_markdown(text), True
+    finally:
+      with self._lock:
+        self.pending -= 1
+        self.busy_seconds += time.perf_counter() - started
+
+    with self._lock:
+      self.completed += 1
+    return html, True
+
+  def background(self, name: str, job) -> threading.Thread | None:
+    # trabajo fuera del request (re-render de un capitulo enorme): uno por nombre a la vez,
+    # los pedidos repetidos mientras corre no arman otro
+    with self._lock:
+      if name in self._background:
+        return None
+      self._background.add(name)
+      self.background_jobs += 1
+
+    def run():
+      try:
+        job()
+      except Exception:
+        with self._lock:
+          self.background_errors += 1
+        raise
+      finally:
+        with self._lock:
+          self._background.discard(name)
+
+    thread = threading.Thread(target=run, name=f"render {name}", daemon=True)
+    thread.start()
+    return thread
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "workers": self.workers,
+        "threshold": self.threshold,
+        "timeout": self.timeout,
+        "inline": self.inline,
+        "submitted": self.submitted,
+        "completed": self.completed,
+        "timeouts": self.timeouts,
+        "errors": self.errors,
+        "restarts": self.restarts,
+        "pending": self.pending,
+        "busy_seconds": round(self.busy_seconds, 3),
+        "background_running": len(self._background),
+        "background_jobs": self.background_jobs,
+        "background_errors": self.background_errors,
+      }
+
+
+render_service = RenderService()
+
+
+def rendered_key(key: str, content_hash: str) -> str:
+  return f"{key}.{content_hash[:16]}.html"
+
+
+def index_key(key: str, content_hash: str) -> str:
+  return f"{key}.{content_hash[:16]}.toc.json"
+
+
+_ARTIFACT_RE = re.compile(r"[0-9a-f]{16}\.(?:html|toc\.json)")
+
+
+def _source_lines(f, hasher=None):
+  with f:
+    for raw in f:
+      if hasher is not None:
+        hasher.update(raw)
+      yield raw.decode("utf-8", errors="ignore")
+
+
+_FOOTNOTE_DEF_RE = re.compile(r"^ {0,3}\[\^([^\]]+)\]:[ \t]?(.*)$", re.S)
+_FOOTNOTE_REF_RE = re.compile(r"\[\^([^\]]+)\]")
+_LINK_DEF_RE = re.compile(r"^ {0,3}\[([^\]^][^\]]*)\]:[ \t]*\S")
+_LINK_REF_RE = re.compile(r"\[([^\]^][^\]]*)\]")
+
+
+def _classify(lines):
+  # (linea, dentro de un bloque de codigo, nota) donde nota es el id de la nota al pie que define
+  # la linea ([^id]: texto y sus lineas con sangria), o None
+  fence = None
+  note = None
+  for line in lines:
+    if note is not None and (not line.strip() or line[:1] in (" ", "\t")):
+      yield line, False, note
+      continue
+    note = None
+    marker = line.lstrip()[:3]
+    if fence is not None:
+      if marker == fence:
+        fence = None
+      yield line, True, None
+    elif marker in ("```", "~~~"):
+      fence = marker
+      yield line, True, None
+    else:
+      match = _FOOTNOTE_DEF_RE.match(line)
+      if match:
+        note = match.group(1)
+      yield line, False, note
+
+
+def _definitions(lines) -> tuple[dict, dict]:
+  # primera pasada: links por referencia ([id]: url) y notas al pie ([^id]: texto) de todo el
+  # documento. Las secciones se renderizan por separado: cada una lleva las que usa
+  links = {}
+  notes = {}
+  for line, in_fence, note in _classify(lines):
+    if note is not None:
+      notes.setdefault(note, []).append(line)
+    elif not in_fence:
+      match = _LINK_DEF_RE.match(line)
+      if match:
+        links.setdefault(match.group(1).lower(), line)
+  return links, notes
+
+
+def _with_definitions(block: list[str], n: int, links: dict, notes: dict, used_links: set, used_notes: dict) -> str:
+  # la seccion + las definiciones que usa. Las notas cambian de id (fn:<id>-<n>): cada seccion arma su
+  # propia lista y sin el sufijo los ids se repetirian en la pagina del lector
+  tail = [links[label] for label in used_links]
+  for label in used_notes:
+    first, *rest = notes[label]
+    tail.append(f"[^{label}-{n}]: {_FOOTNOTE_DEF_RE.match(first).group(2)}")
+    tail.extend(rest)
+  if not tail:
+    return "".join(block)
+  return "".join(block) + "\n\n" + "".join(line if line.endswith("\n") else line + "\n" for line in tail)
+
+
+def _markdown_sections(lines, definitions=({}, {}), section_bytes: int = SECTION_BYTES,
+                       block_bytes: int = RENDER_BLOCK_BYTES):
+  # (markdown, titulos) por seccion. Nunca se corta dentro de un bloque de codigo (``` o ~~~).
+  # A cada titulo se le agrega un id ({: #id } de attr_list) para poder linkearlo desde el indice.
+  # definitions = _definitions() del mismo documento: las notas se sacan de donde estan y van al
+  # final de cada seccion que las cita
+  links, notes = definitions
+  block = []
+  headings = []
+  size = 0
+  n = 0
+  used = {}
+  used_links = set()
+  used_notes = {}
+
+  def rename_note(match):
+    label = match.group(1)
+    if label not in notes:
+      return match.group(0)
+    used_notes[label] = True
+    return f"[^{label}-{n}]"
+
+  for line, in_fence, note in _classify(lines):
+    if note is not None and note in notes:
+      continue
+    heading = _HEADING_RE.match(line) if not in_fence else None
+    if heading and not heading.group(2).endswith("}"):
+      if block and size >= section_bytes:
+        yield _with_definitions(block, n, links, notes, used_links, used_notes), headings
+        block, headings, size, n = [], [], 0, n + 1
+        used_links, used_notes = set(), {}
+      title = clean_markdown_line(heading.group(2)) or heading.group(2)
+      slug = "-".join(tokenize(title)) or "seccion"
+      used[slug] = used.get(slug, 0) + 1
+      anchor = slug if used[slug] == 1 else f"{slug}-{used[slug]}"
+      headings.append((len(heading.group(1)), title, anchor))
+      line = f"{heading.group(1)} {heading.group(2)} {{: #{anchor} }}\n"
+    if not in_fence:
+      if notes and "[^" in line:
+        line = _FOOTNOTE_REF_RE.sub(rename_note, line)
+      if links and "[" in line:
+        used_links.update(label for label in map(str.lower, _LINK_REF_RE.findall(line)) if label in links)
+
+    block.append(line)
+    size += len(line)
+    if not in_fence and size >= block_bytes and not line.strip():
+      yield _with_definitions(block, n, links, notes, used_links, used_notes), headings
+      block, headings, size, n = [], [], 0, n + 1
+      used_links, used_notes = set(), {}
+  if block:
+    yield _with_definitions(block, n, links, notes, used_links, used_notes), headings
+
+
+def render_blocks(backend, key: str):
+  # HTML del .md de a una seccion por vez (para mandarlo en streaming sin artefacto)
+  definitions = _definitions(_source_lines(backend.open(key)))
+  for block, _ in _markdown_sections(_source_lines(backend.open(key)), definitions):
+    yield render_service.render(block)[0]
+
+
+def prerender(backend, key: str, wait: bool = False) -> str:
+  # renderiza el .md al artefacto + indice y devuelve su hash. Se escriben en temporales locales
+  # y se suben enteros (nunca quedan a medias); el indice va ultimo porque es lo que busca el lector.
+  # Si algun bloque no se llego a renderizar a tiempo el indice no se escribe: el lector
+  # muestra el artefacto como esta y se reintenta en la proxima lectura (los capitulos enormes,
+  # en segundo plano: ver chapter_index en app.py) o con chapters-render
+  hasher = hashlib.sha256()
+  sections = []
+  toc = []
+  offset = 0
+  complete = True
+  tmp = backend.tmp_path(f"{uuid.uuid4().hex}.render")
+  try:
+    definitions = _definitions(_source_lines(backend.open(key)))
+    with open(tmp, "wb") as f:
+      for n, (block, headings) in enumerate(_markdown_sections(_source_lines(backend.open(key), hasher), definitions)):
+        html, ok = render_service.render(block, wait)
+        complete = complete and ok
+        html = html.encode("utf-8")
+        f.write(html)
+        sections.append([offset, len(html)])
+        offset += len(html)
+        toc.extend({"level": level, "title": title, "id": anchor, "section": n} for level, title, anchor in headings)
+    content_hash = hasher.hexdigest()
+    backend.put_file(rendered_key(key, content_hash), tmp)
+    if not complete:
+      return content_hash
+
+    with open(tmp, "w", encoding="utf-8") as f:
+      json.dump({"sections": sections or [[0, 0]], "toc": toc}, f, ensure_ascii=False)
+    backend.put_file(index_key(key, content_hash), tmp)
+    return content_hash
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+
+def read_index(backend, key: str, content_hash: str | None) -> str | None:
+  # el json del indice tal cual (se cachea como texto); None si todavia no se pre-renderizo
+  if not content_hash:
+    return None
+  try:
+    with backend.open(index_key(key, content_hash)) as f:
+      return f.read().decode("utf-8")
+  except FileNotFoundError:
+    return None
+
+
+def read_section(backend, key: str, content_hash: str, index: dict, n: int) -> str | None:
+  # HTML de una seccion: una lectura por rango, cueste lo mismo sea la 1 o la 200
+  if not 0 <= n < len(index["sections"]):
+    return None
+  offset, length = index["sections"][n]
+  try:
+    return backend.read_range(rendered_key(key, content_hash), offset, length).decode("utf-8")
+  except FileNotFoundError:
+    return None
+
+
+def iter_rendered(backend, key: str, content_hash: str | None, chunk_size: int = 64 * 1024):
+  # el artefacto de a pedazos (para streaming); None si no existe
+  if not content_hash:
+    return None
+  try:
+    f = io.TextIOWrapper(backend.open(rendered_key(key, content_hash)), encoding="utf-8")
+  except FileNotFoundError:
+    return None
+
+  def chunks():
+    with f:
+      while chunk := f.read(chunk_size):
+        yield chunk
+  return chunks()
+
+
+def remove_rendered(backend, key: str):
+  prefix = f"{key}."
+  for artifact in list(backend.list(prefix)):
+    if _ARTIFACT_RE.fullmatch(artifact[len(prefix):]):
+      backend.delete(artifact)
+
+
+#--------------------
+#Cache en memoria del HTML ya renderizado, con tope en bytes (no en cantidad: un capitulo largo
+#ocupa como cientos de cortos). La clave es (archivo, tamaño, mtime): si el .md cambia, cambia la clave
+class HtmlCache:
+  def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._entries: OrderedDict = OrderedDict()  # key -> (html, bytes)
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def init_app(self, app):
+    app.config.setdefault("RENDER_CACHE_BYTES", self.max_bytes)
+    self.max_bytes = app.config["RENDER_CACHE_BYTES"]
+    app.extensions["render_cache"] = self
+
+  def __len__(self):
+    return len(self._entries)
+
+  @staticmethod
+  def key_for(backend, key: str):
+    st = backend.stat(key)
+    if st is None:
+      raise FileNotFoundError(key)
+    return (key, st.size, st.mtime_ns)
+
+  def get(self, key) -> str | None:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, html: str):
+    cost = sys.getsizeof(html)
+    if cost > self.max_bytes:
+      return
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.size -= old[1]
+      self._entries[key] = (html, cost)
+      self.size += cost
+      while self.size > self.max_bytes:
+        _, (_, freed) = self._entries.popitem(last=False)
+        self.size -= freed
+        self.evictions += 1
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "bytes": self.size,
+        "max_bytes": self.max_bytes,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+      }
+
+
+html_cache = HtmlCache()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+#--------------------
+#Cache de resultados: guarda listas de ids (no objetos) para las consultas que se repiten
+#(busquedas populares, "ultimos actualizados" del home). Un acierto cuesta solo el fetch por PK.
+#Cada entrada lleva tags ("books", "chapters"); los commits que tocan esas tablas las invalidan
+#(ver models/cache_tags.py). El TTL acota lo viejo que puede quedar en los otros workers.
+
+_MISSING = object()
+
+
+class ResultCache:
+  def __init__(self, max_entries: int = 1024, ttl: float = 30.0):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self._entries: OrderedDict = OrderedDict()  # key -> (expira, tags, valor)
+    self._tags: dict[str, set] = {}
+    self._lock = threading.RLock()
+    self.hits = 0
+    self.misses = 0
+
+  def init_app(self, app):
+    app.config.setdefault("RESULT_CACHE_SIZE", self.max_entries)
+    app.config.setdefault("RESULT_CACHE_TTL", self.ttl)
+    self.max_entries = app.config["RESULT_CACHE_SIZE"]
+    self.ttl = app.config["RESULT_CACHE_TTL"]
+    app.extensions["result_cache"] = self
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+          self._drop(key)
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[2]
+
+  def set(self, key, value, tags=()):
+    tags = frozenset(tags)
+    with self._lock:
+      self._drop(key)
+      self._entries[key] = (time.monotonic() + self.ttl, tags, value)
+      for tag in tags:
+        self._tags.setdefault(tag, set()).add(key)
+      while len(self._entries) > self.max_entries:
+        self._drop(next(iter(self._entries)))
+
+  def get_or_set(self, key, compute, tags=()):
+    value = self.get(key, _MISSING)
+    if value is _MISSING:
+      value = compute()
+      self.set(key, value, tags)
+    return value
+
+  def invalidate(self, *tags):
+    with self._lock:
+      for tag in tags:
+        for key in self._tags.pop(tag, ()):
+          self._drop(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._tags.clear()
+
+  def _drop(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return
+    for tag in entry[1]:
+      keys = self._tags.get(tag)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self._tags[tag]
+
+
+result_cache = ResultCache()
@@ -0,0 +1,9 @@
+from .text import fold, tokenize
+from .index import InvertedIndex, intersect
+from .fuzzy import TrigramIndex, trigrams
+from .suggest import TitleSuggester
+from .engine import BookSearch, ChapterSearch, highlight
+from .extract import extract_chapter
+
+book_search = BookSearch()
+chapter_search = ChapterSearch()
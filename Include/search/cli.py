@@ -0,0 +1,61 @@
+import json
+import os
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Chapter, ChapterTerms
+from .extract import extract_chapter
+from .segment import Segment, current_segment_path
+
+search_index_cli = AppGroup("search-index", help="Indices de busqueda persistidos.")
+
+_EXTENSIONS = ("book_search", "chapter_search")
+
+
+@search_index_cli.command("build")
+def build_command():
+  """Genera una version nueva de los indices y la publica (los workers la toman solos)."""
+  for name in _EXTENSIONS:
+    path = current_app.extensions[name].build_segment()
+    click.echo(f"indice publicado: {path} ({os.path.getsize(path)} bytes)")
+
+
+@search_index_cli.command("info")
+def info_command():
+  """Muestra las versiones publicadas."""
+  for name in _EXTENSIONS:
+    search = current_app.extensions[name]
+    path = current_segment_path(current_app.config["SEARCH_INDEX_DIR"], search.NAME)
+    if path is None:
+      click.echo(f"{search.NAME}: no hay indice publicado")
+      continue
+    segment = Segment(path)
+    click.echo(f"{path}: {segment.doc_count} documentos, {segment.term_count} terminos, hasta {segment.watermark or '-'}")
+    segment.close()
+
+
+@search_index_cli.command("chapters-backfill")
+def chapters_backfill_command():
+  """Extrae los terminos de los capitulos subidos antes de que existiera el indice."""
+  pending = (
+    Chapter.query.outerjoin(ChapterTerms, ChapterTerms.chapter_id == Chapter.id)
+    .filter(ChapterTerms.chapter_id.is_(None))
+    .order_by(Chapter.id.asc())
+    .all()
+  )
+  done = 0
+  for ch in pending:
+    filename = ch.content_url.split("/uploads/", 1)[-1]
+    stream = None
+    if filename.lower().endswith(".md"):
+      try:
+        stream = current_app.extensions["blob_storage"].backend.open(filename)
+      except FileNotFoundError:
+        pass
+    terms, snippets = extract_chapter(ch.title, stream)
+    db.session.add(ChapterTerms(chapter_id=ch.id, terms=json.dumps(terms), snippets=json.dumps(snippets)))
+    db.session.commit()
+    done += 1
+  click.echo(f"{done} capitulos indexados")
@@ -0,0 +1,394 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from markupsafe import Markup, escape
+
+from models import db, Book, Chapter, ChapterTerms, SearchTombstone
+from pagination import offset_page
+from .fuzzy import TrigramIndex
+from .index import InvertedIndex
+from .ranking import fetch_in_order, rank
+from .suggest import TitleSuggester
+from .segment import LayeredIndex, Segment, current_segment_path, publish_segment
+from .text import MIN_PREFIX_LEN, iter_words, tokenize
+
+
+class SegmentedSearch:
+  # indice publicado en disco (mmap) + lo que cambio despues, traido de la db por watermark.
+  # Las subclases definen que se indexa (_load) y como se guarda el watermark.
+  NAME = ""
+  EXTENSION = ""
+  FIELDS: tuple[str, ...] = ()
+
+  def __init__(self, app=None):
+    self._index: LayeredIndex | None = None
+    self._lock = threading.Lock()
+    self._directory = None
+    # version publicada que tenemos abierta (mtime del puntero)
+    self._pointer_mtime = None
+    # hasta donde llegamos en la db, para traer lo que cambiaron otros workers
+    self._watermark = None
+    self._synced_at = 0.0
+    self._sync_interval = 5
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault("SEARCH_INDEX_DIR", os.path.join(app.instance_path, "search"))
+    app.config.setdefault("SEARCH_SYNC_INTERVAL", 5)  # segundos entre sincronizaciones con la db
+    self._directory = app.config["SEARCH_INDEX_DIR"]
+    self._sync_interval = app.config["SEARCH_SYNC_INTERVAL"]
+    app.extensions[self.EXTENSION] = self
+
+    from .cli import search_index_cli
+    if search_index_cli.name not in app.cli.commands:
+      app.cli.add_command(search_index_cli)
+
+  def _changes_since(self, since, index):
+    # (doc_id, valores, marca) de lo posterior a since (None = todo); valores None = baja.
+    # index es el que se esta llenando (para no releer lo que ya tiene)
+    raise NotImplementedError
+
+  def _load(self, index, since, live: bool = False):
+    # agrega a index lo posterior a since y devuelve el watermark nuevo.
+    # live: el indice es el que atiende consultas (los indices auxiliares tambien se enteran)
+    watermark = since
+    for doc_id, values, mark in self._changes_since(since, index):
+      if values is None:
+        index.remove(doc_id)  # baja (tombstone)
+      else:
+        self._apply(index, doc_id, values)
+      if live:
+        self._on_change(doc_id, values)
+      if mark is not None and (watermark is None or mark > watermark):
+        watermark = mark
+    return watermark
+
+  def _on_change(self, doc_id, values):
+    pass
+
+  def _parse_watermark(self, text: str):
+    raise NotImplementedError
+
+  def _format_watermark(self, value) -> str:
+    return "" if value is None else str(value)
+
+  def _pointer_stat(self):
+    try:
+      return os.stat(os.path.join(self._directory, f"{self.NAME}.current")).st_mtime_ns
+    except FileNotFoundError:
+      return None
+
+  def _open(self) -> LayeredIndex:
+    # arranque rapido: se mapea la ultima version publicada y solo se trae de la db
+    # lo que cambio desde que se genero; si no hay ninguna se arma todo en memoria
+    self._pointer_mtime = self._pointer_stat()
+    path = current_segment_path(self._directory, self.NAME)
+    segment = None
+    if path is not None:
+      try:
+        segment = Segment(path)
+      except (OSError, ValueError):
+        segment = None
+    if segment is not None and segment.fields != self.FIELDS:
+      segment = None
+
+    index = LayeredIndex(self.FIELDS, segment)
+    since = self._parse_watermark(segment.watermark) if segment is not None and segment.watermark else None
+    self._watermark = self._load(index, since, live=True)
+    return index
+
+  def build_segment(self) -> str:
+    # lo usa `flask search-index build`: genera una version nueva y la publica
+    index = InvertedIndex(self.FIELDS)
+    watermark = self._load(index, None)
+    path = publish_segment(self._directory, self.NAME, index, self._format_watermark(watermark))
+    self._published(watermark)
+    return path
+
+  def _published(self, watermark):
+    pass
+
+  def sync(self, index: LayeredIndex):
+    # los cambios de este proceso llegan por apply_changes(); aca solo se levantan
+    # los hechos en otros workers (altas, ediciones y bajas)
+    self._watermark = self._load(index, self._watermark, live=True)
+
+  def index(self) -> LayeredIndex:
+    if self._index is None:
+      with self._lock:
+        if self._index is None:
+          self._index = self._open()
+          self._synced_at = time.monotonic()
+    elif time.monotonic() - self._synced_at > self._sync_interval:
+      # si otro request ya esta sincronizando no lo esperamos
+      if self._lock.acquire(blocking=False):
+        try:
+          if self._pointer_stat() != self._pointer_mtime:
+            self._index = self._open()  # se publico una version nueva
+          else:
+            self.sync(self._index)
+          self._synced_at = time.monotonic()
+        finally:
+          self._lock.release()
+    return self._index
+
+  def apply_changes(self, changes: dict):
+    # {doc_id: valores} o {doc_id: None} si se borro; lo llama el after_commit de la sesion
+    index = self._index
+    if index is None:
+      return  # todavia no se abrio: cuando se abra ya va a incluir estos cambios
+    for doc_id, values in changes.items():
+      if values is None:
+        index.remove(doc_id)
+      else:
+        self._apply(index, doc_id, values)
+      self._on_change(doc_id, values)
+
+  def _apply(self, index, doc_id, values):
+    index.add(doc_id, values)
+
+  def match_ids(self, q: str) -> list[int]:
+    return self.index().search(q)
+
+
+class BookSearch(SegmentedSearch):
+  NAME = "books"
+  EXTENSION = "book_search"
+  FIELDS = ("title", "subtitle", "description")
+
+  def __init__(self, app=None):
+    self._sync_overlap = timedelta(seconds=30)
+    self._weights = {}
+    # indice de trigramas para la busqueda aproximada, se arma la primera vez que hace falta
+    self._fuzzy: TrigramIndex | None = None
+    self._fuzzy_threshold = 0.5
+    self._fuzzy_limit = 200
+    self._max_in_ids = 1000
+    # titulos ordenados para el autocompletado, tambien se arma la primera vez que se usa
+    self._suggester: TitleSuggester | None = None
+    super().__init__(app)
+
+  def init_app(self, app):
+    super().init_app(app)
+    app.config.setdefault("SEARCH_SYNC_OVERLAP", 30)  # margen por transacciones que commitean tarde
+    # peso de cada campo en el orden por relevancia
+    app.config.setdefault("SEARCH_FIELD_WEIGHTS", {"title": 3.0, "subtitle": 2.0, "description": 1.0})
+    self._sync_overlap = timedelta(seconds=app.config["SEARCH_SYNC_OVERLAP"])
+    self._weights = app.config["SEARCH_FIELD_WEIGHTS"]
+    app.config.setdefault("SEARCH_FUZZY_THRESHOLD", 0.5)  # fraccion de trigramas de la consulta que tienen que coincidir
+    app.config.setdefault("SEARCH_FUZZY_LIMIT", 200)
+    self._fuzzy_threshold = app.config["SEARCH_FUZZY_THRESHOLD"]
+    self._fuzzy_limit = app.config["SEARCH_FUZZY_LIMIT"]
+    # con mas coincidentes que esto no se manda un IN (...) a la db (ver restrict)
+    app.config.setdefault("SEARCH_MAX_IN_IDS", 1000)
+    self._max_in_ids = app.config["SEARCH_MAX_IN_IDS"]
+
+  def _parse_watermark(self, text):
+    return datetime.fromisoformat(text)
+
+  def _format_watermark(self, value):
+    return "" if value is None else value.isoformat()
+
+  def _changes_since(self, since, index):
+    # altas y ediciones por last_update_date
+    rows = db.session.query(
+      Book.id, Book.title, Book.subtitle, Book.description, Book.last_update_date
+    )
+    if since is None:
+      rows = rows.order_by(Book.id.asc()).execution_options(yield_per=2000)
+    else:
+      rows = rows.filter(Book.last_update_date >= since - self._sync_overlap)
+    for book_id, title, subtitle, description, updated in rows:
+      yield book_id, {"title": title, "subtitle": subtitle, "description": description}, updated
+    if since is not None:
+      # bajas: una vez borrado el libro solo queda el tombstone (reaplicarlo no cambia nada)
+      tombstones = db.session.query(SearchTombstone.doc_id, SearchTombstone.creation_date).filter(
+        SearchTombstone.index_name == self.NAME, SearchTombstone.creation_date >= since - self._sync_overlap
+      )
+      for book_id, deleted in tombstones:
+        yield book_id, None, deleted
+
+  def _published(self, watermark):
+    # la version nueva ya no tiene los libros borrados: los tombstones anteriores a ella sobran
+    # (los workers que usan la version anterior abren la nueva antes de volver a sincronizar)
+    if watermark is None:
+      return
+    tombstones = SearchTombstone.__table__
+    db.session.execute(tombstones.delete().where(
+      tombstones.c.index_name == self.NAME, tombstones.c.creation_date < watermark - self._sync_overlap
+    ))
+    db.session.commit()
+
+  def _on_change(self, doc_id, values):
+    fuzzy, suggester = self._fuzzy, self._suggester
+    if values is None:
+      if fuzzy is not None:
+        fuzzy.remove(doc_id)
+      if suggester is not None:
+        suggester.remove(doc_id)
+    else:
+      if fuzzy is not None:
+        fuzzy.add(doc_id, _fuzzy_text(values["title"], values["subtitle"]))
+      if suggester is not None:
+        suggester.add(doc_id, values["title"])
+
+  def fuzzy(self) -> TrigramIndex:
+    self.index()  # de paso sincroniza: los cambios llegan por _on_change
+    if self._fuzzy is None:
+      with self._lock:
+        if self._fuzzy is None:
+          fuzzy = TrigramIndex(self._fuzzy_threshold)
+          rows = db.session.query(Book.id, Book.title, Book.subtitle).execution_options(yield_per=2000)
+          for book_id, title, subtitle in rows:
+            fuzzy.add(book_id, _fuzzy_text(title, subtitle))
+          self._fuzzy = fuzzy
+    return self._fuzzy
+
+  def suggester(self) -> TitleSuggester:
+    self.index()
+    if self._suggester is None:
+      with self._lock:
+        if self._suggester is None:
+          suggester = TitleSuggester()
+          suggester.build(db.session.query(Book.id, Book.title).execution_options(yield_per=5000))
+          self._suggester = suggester
+    return self._suggester
+
+  def suggest(self, prefix: str, limit: int = 8) -> list[tuple[int, str]]:
+    # autocompletado: sale de memoria, no consulta la db por cada tecla. Las bajas y ediciones de
+    # otros workers llegan con sync() (cada SEARCH_SYNC_INTERVAL segundos)
+    return self.suggester().suggest(prefix, limit)
+
+  def fuzzy_ids(self, q: str) -> list[int]:
+    # ids ordenados por parecido de titulo/subtitulo; solo para cuando la busqueda exacta no da nada
+    return [doc_id for doc_id, _ in self.fuzzy().search(q, limit=self._fuzzy_limit)]
+
+  def filter_ids(self, query, ids: list[int]):
+    if not ids:
+      return query.filter(db.false())
+    return query.filter(Book.id.in_(ids))
+
+  def restrict(self, query, ids: list[int]):
+    # (consulta, keep) para keyset_paginate. Pocos ids van a la db como IN (...). Con terminos muy
+    # comunes son decenas de miles y ese IN es lo mas caro de la pagina: se devuelven como keep y la
+    # paginacion recorre el orden filtrando en memoria (con tantos coincidentes lee pocas filas)
+    if len(ids) > self._max_in_ids:
+      return query, set(ids)
+    return self.filter_ids(query, ids), None
+
+  def page_by_relevance(self, query, q: str, cursor: str | None, per_page: int, scope: str):
+    # orden BM25: se puntuan todos los candidatos pero solo se traen de la db los de la pagina
+    scores = self.index().score(q, self._weights)
+    load = lambda offset, limit: fetch_in_order(query, Book.id, rank(scores, offset + limit)[offset:])
+    return offset_page(load, cursor, per_page, scope)
+
+  def page_ids(self, query, ids: list[int], cursor: str | None, per_page: int, scope: str):
+    # ids ya ordenados (ej. resultados aproximados)
+    load = lambda offset, limit: fetch_in_order(query, Book.id, ids[offset:offset + limit])
+    return offset_page(load, cursor, per_page, scope)
+
+
+def _fuzzy_text(title, subtitle) -> str:
+  return " ".join(part for part in (title, subtitle) if part)
+
+
+class ChapterSearch(SegmentedSearch):
+  NAME = "chapters"
+  EXTENSION = "chapter_search"
+  FIELDS = ("title", "body")
+
+  def __init__(self, app=None):
+    self._sync_overlap = 1000
+    super().__init__(app)
+
+  def init_app(self, app):
+    super().init_app(app)
+    # ids anteriores al watermark que se vuelven a mirar: un capitulo con id menor puede
+    # commitear despues que uno mayor (transacciones en paralelo)
+    app.config.setdefault("SEARCH_CHAPTER_SYNC_OVERLAP", 1000)
+    self._sync_overlap = app.config["SEARCH_CHAPTER_SYNC_OVERLAP"]
+
+  def _parse_watermark(self, text):
+    return int(text)
+
+  def _changes_since(self, since, index):
+    # los capitulos no se editan: alcanza con traer los ids nuevos y, del margen anterior al
+    # watermark, los que todavia no estan en el indice (solo los ids: los terminos son lo pesado)
+    rows = db.session.query(ChapterTerms.chapter_id, ChapterTerms.terms)
+    if since is not None:
+      recent = db.session.query(ChapterTerms.chapter_id).filter(
+        ChapterTerms.chapter_id > since - self._sync_overlap, ChapterTerms.chapter_id <= since
+      )
+      late = [chapter_id for chapter_id, in recent if chapter_id not in index]
+      newer = ChapterTerms.chapter_id > since
+      rows = rows.filter(db.or_(newer, ChapterTerms.chapter_id.in_(late)) if late else newer)
+    rows = rows.order_by(ChapterTerms.chapter_id.asc()).execution_options(yield_per=200)
+    for chapter_id, terms in rows:
+      yield chapter_id, json.loads(terms), chapter_id
+
+  def _apply(self, index, doc_id, values):
+    index.add_frequencies(doc_id, values)
+
+  def search(self, q: str, limit: int = 10) -> list[tuple[Chapter, Markup]]:
+    # capitulos que contienen todos los terminos (los mas nuevos primero) con su snippet resaltado
+    ids = self.match_ids(q)
+    # los ids vienen ordenados: se piden a la db de a ventanas desde el final (los mas nuevos), con
+    # holgura por capitulos borrados. Un termino comun no manda miles de ids en el IN (...)
+    chapters = []
+    end = len(ids)
+    while end > 0 and len(chapters) < limit:
+      start = max(end - 2 * limit, 0)
+      chapters += (
+        Chapter.query.options(db.joinedload(Chapter.book))
+        .filter(Chapter.id.in_(ids[start:end]))
+        .order_by(Chapter.id.desc())
+        .limit(limit - len(chapters))
+        .all()
+      )
+      end = start
+    if not chapters:
+      return []
+
+    snippets = dict(
+      db.session.query(ChapterTerms.chapter_id, ChapterTerms.snippets)
+      .filter(ChapterTerms.chapter_id.in_([c.id for c in chapters]))
+      .all()
+    )
+    terms = tokenize(q)
+    return [(c, highlight(pick_snippet(json.loads(snippets.get(c.id) or "{}"), terms), terms)) for c in chapters]
+
+
+def pick_snippet(snippets: dict, terms: list[str]) -> str:
+  # primero un termino exacto; el ultimo tambien puede venir como prefijo
+  for term in terms:
+    if term in snippets:
+      return snippets[term]
+  last = terms[-1] if terms else ""
+  if len(last) >= MIN_PREFIX_LEN:
+    for term, snippet in snippets.items():
+      if term.startswith(last):
+        return snippet
+  return ""
+
+
+def highlight(text: str, terms: list[str]) -> Markup:
+  # envuelve en <mark> las palabras buscadas; el resto se escapa
+  if not text:
+    return Markup("")
+  exact = set(terms[:-1])
+  last = terms[-1] if terms else ""
+  out = []
+  pos = 0
+  for term, start, end in iter_words(text):
+    if start < pos:
+      continue
+    if term in exact or term == last or (len(last) >= MIN_PREFIX_LEN and term.startswith(last)):
+      out.append(escape(text[pos:start]))
+      out.append(Markup("<mark>%s</mark>") % text[start:end])
+      pos = end
+  out.append(escape(text[pos:]))
+  return Markup("").join(out)
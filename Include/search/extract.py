@@ -0,0 +1,67 @@
+import io
+import re
+
+from .text import iter_words, tokenize
+
+# cuantos terminos distintos guardan snippet y cuanto contexto se toma alrededor
+MAX_SNIPPETS = 3000
+SNIPPET_CONTEXT = 70
+
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_IMAGE_RE = re.compile(r"!\[([^\]]*)\]\([^)]*\)")
+_LINK_RE = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+_HTML_RE = re.compile(r"<[^>]+>")
+_PREFIX_RE = re.compile(r"^\s*(#{1,6}\s+|>\s*|[-*+]\s+|\d+[.)]\s+)+")
+_INLINE_RE = re.compile(r"[*`~|]+|(?<!\w)_+|_+(?!\w)")
+
+
+def clean_markdown_line(line: str) -> str:
+  # texto visible de una linea de markdown (sin sintaxis, links ni html)
+  if _FENCE_RE.match(line):
+    return ""
+  line = _IMAGE_RE.sub(r"\1", line)
+  line = _LINK_RE.sub(r"\1", line)
+  line = _HTML_RE.sub(" ", line)
+  line = _PREFIX_RE.sub("", line)
+  line = _INLINE_RE.sub("", line)
+  return line.strip()
+
+
+def _snippet(line: str, start: int, end: int) -> str:
+  left = max(0, start - SNIPPET_CONTEXT)
+  right = min(len(line), end + SNIPPET_CONTEXT)
+  # no cortar palabras por la mitad
+  if left > 0:
+    space = line.find(" ", left, start)
+    left = space + 1 if space != -1 else left
+  if right < len(line):
+    space = line.rfind(" ", end, right)
+    right = space if space != -1 else right
+  text = line[left:right].strip()
+  return ("…" if left > 0 else "") + text + ("…" if right < len(line) else "")
+
+
+def extract_chapter(title: str, stream=None) -> tuple[dict, dict]:
+  # frecuencias por campo (titulo, texto) y un snippet por termino. stream es el .md abierto en
+  # binario (backend.open): se recorre linea por linea, nunca se carga entero en memoria
+  terms: dict[str, list[int]] = {}
+  snippets: dict[str, str] = {}
+
+  for term in tokenize(title):
+    terms.setdefault(term, [0, 0])[0] += 1
+
+  if stream is not None:
+    with io.TextIOWrapper(stream, encoding="utf-8", errors="ignore") as f:
+      for raw in f:
+        line = clean_markdown_line(raw)
+        if not line:
+          continue
+        for term, start, end in iter_words(line):
+          counts = terms.get(term)
+          if counts is None:
+            counts = terms[term] = [0, 0]
+          counts[1] += 1
+          if term not in snippets and len(snippets) < MAX_SNIPPETS:
+            snippets[term] = _snippet(line, start, end)
+
+  return terms, snippets
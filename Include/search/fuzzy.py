@@ -0,0 +1,79 @@
+import math
+import threading
+from collections import Counter
+
+from .text import tokenize
+
+
+def trigrams(text) -> set[str]:
+  # como pg_trgm: cada palabra se rellena con dos espacios adelante y uno atras
+  grams = set()
+  for word in tokenize(text):
+    padded = f"  {word} "
+    grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+  return grams
+
+
+class TrigramIndex:
+  # tolerante a errores de tipeo sobre titulo y subtitulo ("harri poter" -> Harry Potter)
+  def __init__(self, threshold: float = 0.5):
+    self.threshold = threshold
+    self._postings: dict[str, set[int]] = {}
+    self._docs: dict[int, frozenset[str]] = {}
+    self._lock = threading.RLock()
+
+  def __len__(self):
+    return len(self._docs)
+
+  def add(self, doc_id: int, text: str):
+    grams = frozenset(trigrams(text))
+    with self._lock:
+      self._remove(doc_id)
+      for gram in grams:
+        self._postings.setdefault(gram, set()).add(doc_id)
+      self._docs[doc_id] = grams
+
+  def remove(self, doc_id: int):
+    with self._lock:
+      self._remove(doc_id)
+
+  def _remove(self, doc_id: int):
+    for gram in self._docs.pop(doc_id, ()):
+      ids = self._postings[gram]
+      ids.discard(doc_id)
+      if not ids:
+        del self._postings[gram]
+
+  def search(self, query: str, limit: int | None = None) -> list[tuple[int, float]]:
+    # (id, similitud) ordenados de mayor a menor
+    wanted = trigrams(query)
+    if not wanted:
+      return []
+    # para llegar al umbral un documento tiene que tener al menos `needed` trigramas de la consulta,
+    # asi que alcanza con generar candidatos desde los len(wanted) - needed + 1 mas raros
+    needed = max(1, math.ceil(self.threshold * len(wanted)))
+    with self._lock:
+      lists = sorted((self._postings.get(gram, set()) for gram in wanted), key=len)
+      candidates = set().union(*lists[:len(wanted) - needed + 1])
+
+      overlap = Counter()
+      for ids in lists:
+        if len(ids) < len(candidates):
+          overlap.update(doc_id for doc_id in ids if doc_id in candidates)
+        else:
+          overlap.update(doc_id for doc_id in candidates if doc_id in ids)
+
+      scored = []
+      for doc_id, common in overlap.items():
+        if common < needed:
+          continue
+        # parecido a word_similarity: cuanto de la consulta aparece en el titulo,
+        # desempatando por jaccard para preferir titulos mas cortos
+        coverage = common / len(wanted)
+        jaccard = common / (len(wanted) + len(self._docs[doc_id]) - common)
+        scored.append((doc_id, coverage, jaccard))
+
+    scored.sort(key=lambda item: (item[1], item[2], item[0]), reverse=True)
+    if limit is not None:
+      scored = scored[:limit]
+    return [(doc_id, coverage) for doc_id, coverage, _ in scored]
@@ -0,0 +1,180 @@
+import threading
+from bisect import bisect_left, insort
+
+from .text import tokenize, MIN_PREFIX_LEN
+
+
+def intersect(lists: list[list[int]]) -> list[int]:
+  # interseccion de listas ordenadas, empezando por la mas corta
+  if not lists:
+    return []
+  lists = sorted(lists, key=len)
+  result = lists[0]
+  for other in lists[1:]:
+    if not result:
+      break
+    result = _intersect_two(result, other)
+  return list(result)
+
+
+def _intersect_two(small: list[int], big: list[int]) -> list[int]:
+  out = []
+  if len(big) > 8 * len(small):
+    # lista muy despareja: busqueda binaria de cada id de la chica en la grande
+    lo = 0
+    for doc_id in small:
+      lo = bisect_left(big, doc_id, lo)
+      if lo == len(big):
+        break
+      if big[lo] == doc_id:
+        out.append(doc_id)
+    return out
+
+  i = j = 0
+  while i < len(small) and j < len(big):
+    a, b = small[i], big[j]
+    if a == b:
+      out.append(a)
+      i += 1
+      j += 1
+    elif a < b:
+      i += 1
+    else:
+      j += 1
+  return out
+
+
+class InvertedIndex:
+  def __init__(self, fields):
+    self.fields = tuple(fields)
+    # termino -> ids de documentos (ordenados)
+    self._postings: dict[str, list[int]] = {}
+    # id -> {termino: frecuencia por campo}, sirve para sacar/actualizar documentos
+    self._docs: dict[int, dict[str, tuple[int, ...]]] = {}
+    # largo de cada campo por documento y totales, para el ranking
+    self._lengths: dict[int, tuple[int, ...]] = {}
+    self._totals = [0] * len(self.fields)
+    # vocabulario ordenado para expandir prefijos, se arma cuando hace falta
+    self._vocabulary: list[str] | None = None
+    self._lock = threading.RLock()
+
+  def __len__(self):
+    return len(self._docs)
+
+  def __contains__(self, doc_id):
+    return doc_id in self._docs
+
+  def add(self, doc_id: int, values: dict):
+    freqs: dict[str, list[int]] = {}
+    for pos, field in enumerate(self.fields):
+      for term in tokenize(values.get(field)):
+        counts = freqs.get(term)
+        if counts is None:
+          counts = freqs[term] = [0] * len(self.fields)
+        counts[pos] += 1
+    self.add_frequencies(doc_id, freqs)
+
+  def add_frequencies(self, doc_id: int, freqs: dict):
+    # {termino: frecuencia por campo}, para documentos que ya vienen tokenizados (capitulos)
+    with self._lock:
+      if doc_id in self._docs:
+        self._remove(doc_id)
+      for term in freqs:
+        ids = self._postings.get(term)
+        if ids is None:
+          self._postings[term] = [doc_id]
+          self._vocabulary = None
+        elif ids[-1] < doc_id:
+          ids.append(doc_id)  # caso comun al indexar en orden de id
+        else:
+          insort(ids, doc_id)
+      self._docs[doc_id] = {term: tuple(counts) for term, counts in freqs.items()}
+      lengths = [0] * len(self.fields)
+      for counts in freqs.values():
+        for pos, tf in enumerate(counts):
+          lengths[pos] += tf
+      self._lengths[doc_id] = tuple(lengths)
+      for pos, size in enumerate(lengths):
+        self._totals[pos] += size
+
+  def remove(self, doc_id: int):
+    with self._lock:
+      if doc_id in self._docs:
+        self._remove(doc_id)
+
+  def _remove(self, doc_id: int):
+    for pos, size in enumerate(self._lengths.pop(doc_id)):
+      self._totals[pos] -= size
+    for term in self._docs.pop(doc_id):
+      ids = self._postings[term]
+      pos = bisect_left(ids, doc_id)
+      if pos < len(ids) and ids[pos] == doc_id:
+        del ids[pos]
+      if not ids:
+        del self._postings[term]
+        self._vocabulary = None
+
+  def postings(self, term: str) -> list[int]:
+    return self._postings.get(term, [])
+
+  def expand_prefix(self, prefix: str) -> list[str]:
+    vocabulary = self._vocabulary
+    if vocabulary is None:
+      with self._lock:
+        vocabulary = self._vocabulary = sorted(self._postings)
+    start = bisect_left(vocabulary, prefix)
+    end = bisect_left(vocabulary, prefix + "\uffff", start)
+    return vocabulary[start:end]
+
+  def doc_ids(self) -> list[int]:
+    return sorted(self._docs)
+
+  def terms(self) -> list[str]:
+    return sorted(self._postings)
+
+  def frequencies(self, doc_id: int) -> dict[str, tuple[int, ...]]:
+    return self._docs.get(doc_id, {})
+
+  def term_frequencies(self, term: str) -> dict[int, tuple[int, ...]]:
+    return {doc_id: self._docs[doc_id][term] for doc_id in self.postings(term)}
+
+  def field_lengths(self, doc_id: int) -> tuple[int, ...] | None:
+    return self._lengths.get(doc_id)
+
+  def stats(self) -> tuple[int, tuple[int, ...]]:
+    # (cantidad de documentos, largo total de cada campo)
+    return len(self._docs), tuple(self._totals)
+
+  def search(self, query: str) -> list[int]:
+    with self._lock:
+      return run_query(self, query)
+
+
+def query_terms(index, query: str) -> list[list[str]]:
+  # un grupo por termino de la consulta; el ultimo se expande como prefijo
+  terms = tokenize(query)
+  if not terms:
+    return []
+  groups = [[term] for term in dict.fromkeys(terms[:-1])]
+  last = terms[-1]
+  if len(last) >= MIN_PREFIX_LEN:
+    groups.append(index.expand_prefix(last))
+  else:
+    groups.append([last])
+  return groups
+
+
+def run_query(index, query: str) -> list[int]:
+  # todos los terminos tienen que aparecer (AND).
+  # Sirve para cualquier indice con postings() y expand_prefix()
+  groups = query_terms(index, query)
+  if not groups:
+    return []
+
+  lists = []
+  for group in groups:
+    if len(group) == 1:
+      lists.append(index.postings(group[0]))
+    else:
+      lists.append(sorted({doc_id for term in group for doc_id in index.postings(term)}))
+  return intersect(lists)
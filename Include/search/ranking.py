@@ -0,0 +1,68 @@
+import heapq
+import math
+
+from .index import intersect, query_terms
+
+# parametros clasicos de BM25
+K1 = 1.2
+B = 0.75
+
+
+def bm25_scores(index, query: str, weights: dict) -> dict[int, float]:
+  # BM25F: la frecuencia de cada campo se normaliza por su largo y se pondera antes de saturar,
+  # asi un acierto en el titulo pesa mas que uno en la descripcion.
+  # Usa solo largos y estadisticas precalculados en el indice
+  groups = query_terms(index, query)
+  if not groups:
+    return {}
+
+  doc_count, totals = index.stats()
+  if not doc_count:
+    return {}
+  averages = [total / doc_count for total in totals]
+  field_weights = [weights.get(field, 1.0) for field in index.fields]
+
+  # candidatos = documentos con todos los terminos
+  per_group = [{term: index.term_frequencies(term) for term in group} for group in groups]
+  candidates = intersect([sorted({d for freqs in group.values() for d in freqs}) for group in per_group])
+  if not candidates:
+    return {}
+
+  norms = {}
+  for doc_id in candidates:
+    lengths = index.field_lengths(doc_id) or totals
+    norms[doc_id] = [
+      (1 - B + B * size / avg) if avg else 1.0
+      for size, avg in zip(lengths, averages)
+    ]
+
+  scores = dict.fromkeys(candidates, 0.0)
+  for group in per_group:
+    for freqs in group.values():
+      df = len(freqs)
+      idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+      for doc_id in candidates if len(candidates) < df else freqs:
+        counts = freqs.get(doc_id)
+        if counts is None or doc_id not in norms:
+          continue
+        norm = norms[doc_id]
+        tf = sum(w * c / n for w, c, n in zip(field_weights, counts, norm) if c)
+        scores[doc_id] += idf * tf * (K1 + 1) / (tf + K1)
+  return scores
+
+
+def rank(scores: dict[int, float], limit: int | None = None) -> list[int]:
+  # ids por puntaje descendente (a igual puntaje, el mas nuevo primero)
+  key = lambda doc_id: (scores[doc_id], doc_id)
+  if limit is None:
+    return sorted(scores, key=key, reverse=True)
+  return heapq.nlargest(limit, scores, key=key)
+
+
+def fetch_in_order(query, column, ids: list[int]) -> list:
+  # trae de la db solo esos ids y respeta el orden de la lista
+  if not ids:
+    return []
+  position = {doc_id: pos for pos, doc_id in enumerate(ids)}
+  items = query.filter(column.in_(ids)).all()
+  return sorted(items, key=lambda item: position[item.id])
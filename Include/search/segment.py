@@ -0,0 +1,368 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from .index import InvertedIndex, run_query
+from .ranking import bm25_scores
+
+# Formato del archivo (little endian):
+#   header | campos | watermark | tabla de documentos | diccionario de terminos | textos de terminos | postings
+# - tabla de documentos: (doc_id, largo de cada campo) de tamaño fijo, ordenada por doc_id
+# - diccionario: entradas de tamaño fijo ordenadas por termino (utf-8), para busqueda binaria
+# - postings: por documento, varint(doc_id - doc_id anterior) + varint(frecuencia en cada campo)
+MAGIC = b"BKSI"
+VERSION = 1
+_HEADER = struct.Struct("<4sHHIIQQQQ")
+_TERM = struct.Struct("<IHIQI")  # offset del texto, largo, df, offset de postings, bytes de postings
+_STR_LEN = struct.Struct("<H")
+
+
+def _write_varint(buf: bytearray, value: int):
+  while value >= 0x80:
+    buf.append((value & 0x7F) | 0x80)
+    value >>= 7
+  buf.append(value)
+
+
+def _read_varint(data, pos: int) -> tuple[int, int]:
+  result = shift = 0
+  while True:
+    byte = data[pos]
+    pos += 1
+    result |= (byte & 0x7F) << shift
+    if byte < 0x80:
+      return result, pos
+    shift += 7
+
+
+def write_segment(path: str, index: InvertedIndex, watermark: str = ""):
+  nfields = len(index.fields)
+  doc_struct = struct.Struct("<I" + "I" * nfields)
+
+  doc_ids = index.doc_ids()
+  docs = bytearray()
+  for doc_id in doc_ids:
+    lengths = [0] * nfields
+    for counts in index.frequencies(doc_id).values():
+      for pos, tf in enumerate(counts):
+        lengths[pos] += tf
+    docs += doc_struct.pack(doc_id, *lengths)
+
+  term_table = bytearray()
+  term_blob = bytearray()
+  postings = bytearray()
+  terms = sorted(index.terms(), key=lambda t: t.encode("utf-8"))
+  for term in terms:
+    encoded = term.encode("utf-8")
+    ids = index.postings(term)
+    start = len(postings)
+    previous = 0
+    for doc_id in ids:
+      _write_varint(postings, doc_id - previous)
+      previous = doc_id
+      for tf in index.frequencies(doc_id)[term]:
+        _write_varint(postings, tf)
+    term_table += _TERM.pack(len(term_blob), len(encoded), len(ids), start, len(postings) - start)
+    term_blob += encoded
+
+  meta = bytearray()
+  for text in (",".join(index.fields), watermark):
+    encoded = text.encode("utf-8")
+    meta += _STR_LEN.pack(len(encoded)) + encoded
+
+  # la tabla de documentos queda alineada a 4 bytes para leerla como array de uint32
+  meta += b"\0" * (-(_HEADER.size + len(meta)) % 4)
+  doc_off = _HEADER.size + len(meta)
+  term_off = doc_off + len(docs)
+  blob_off = term_off + len(term_table)
+  postings_off = blob_off + len(term_blob)
+  header = _HEADER.pack(
+    MAGIC, VERSION, nfields, len(doc_ids), len(terms), doc_off, term_off, blob_off, postings_off
+  )
+
+  with open(path, "wb") as f:
+    for part in (header, meta, docs, term_table, term_blob, postings):
+      f.write(part)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class Segment:
+  # indice de solo lectura mapeado en memoria: todos los workers comparten las mismas paginas
+  CACHE_SIZE = 512
+
+  def __init__(self, path: str):
+    self.path = path
+    with open(path, "rb") as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, nfields, self.doc_count, self.term_count,
+     self._doc_off, self._term_off, self._blob_off, self._postings_off) = _HEADER.unpack_from(self._mm, 0)
+    if magic != MAGIC or version != VERSION:
+      self.close()
+      raise ValueError(f"{path}: no es un indice de busqueda valido")
+
+    pos = _HEADER.size
+    meta = []
+    for _ in range(2):
+      (size,) = _STR_LEN.unpack_from(self._mm, pos)
+      meta.append(bytes(self._mm[pos + 2:pos + 2 + size]).decode("utf-8"))
+      pos += 2 + size
+    self.fields = tuple(meta[0].split(","))
+    self.watermark = meta[1]
+    self._nfields = nfields
+    self._doc_struct = struct.Struct("<I" + "I" * nfields)
+
+    self._cache: OrderedDict[str, tuple[list[int], list[tuple[int, ...]]]] = OrderedDict()
+    self._cache_lock = threading.Lock()
+    self._doc_table = None
+    self._doc_ids = None
+    self._totals = None
+
+  def close(self):
+    if isinstance(self._doc_table, memoryview):
+      self._doc_ids.release()
+      self._doc_table.release()
+    self._doc_table = self._doc_ids = None
+    self._mm.close()
+
+  def _docs(self):
+    # tabla de documentos como uint32 sin copiarla (en maquinas little endian)
+    if self._doc_table is None:
+      stride = self._nfields + 1
+      start, end = self._doc_off, self._doc_off + self.doc_count * stride * 4
+      if sys.byteorder == "little" and start % 4 == 0:
+        table = memoryview(self._mm)[start:end].cast("I")
+      else:
+        table = array("I", self._mm[start:end])
+        if sys.byteorder != "little":
+          table.byteswap()
+      self._doc_ids = table[0::stride]
+      self._doc_table = table
+    return self._doc_table
+
+  def _term_at(self, i: int) -> bytes:
+    blob, size, _, _, _ = _TERM.unpack_from(self._mm, self._term_off + i * _TERM.size)
+    start = self._blob_off + blob
+    return self._mm[start:start + size]
+
+  def _find(self, encoded: bytes) -> int:
+    lo, hi = 0, self.term_count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._term_at(mid) < encoded:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def document_frequency(self, term: str) -> int:
+    encoded = term.encode("utf-8")
+    i = self._find(encoded)
+    if i < self.term_count and self._term_at(i) == encoded:
+      return _TERM.unpack_from(self._mm, self._term_off + i * _TERM.size)[2]
+    return 0
+
+  def expand_prefix(self, prefix: str) -> list[str]:
+    encoded = prefix.encode("utf-8")
+    out = []
+    i = self._find(encoded)
+    while i < self.term_count:
+      term = self._term_at(i)
+      if not term.startswith(encoded):
+        break
+      out.append(term.decode("utf-8"))
+      i += 1
+    return out
+
+  def _decode(self, term: str) -> tuple[list[int], list[tuple[int, ...]]]:
+    with self._cache_lock:
+      hit = self._cache.get(term)
+      if hit is not None:
+        self._cache.move_to_end(term)
+        return hit
+
+    ids: list[int] = []
+    freqs: list[tuple[int, ...]] = []
+    encoded = term.encode("utf-8")
+    i = self._find(encoded)
+    if i < self.term_count and self._term_at(i) == encoded:
+      _, _, df, offset, _ = _TERM.unpack_from(self._mm, self._term_off + i * _TERM.size)
+      data = self._mm
+      pos = self._postings_off + offset
+      doc_id = 0
+      nfields = self._nfields
+      for _ in range(df):
+        delta, pos = _read_varint(data, pos)
+        doc_id += delta
+        counts = []
+        for _ in range(nfields):
+          tf, pos = _read_varint(data, pos)
+          counts.append(tf)
+        ids.append(doc_id)
+        freqs.append(tuple(counts))
+
+    with self._cache_lock:
+      self._cache[term] = (ids, freqs)
+      if len(self._cache) > self.CACHE_SIZE:
+        self._cache.popitem(last=False)
+    return ids, freqs
+
+  def postings(self, term: str) -> list[int]:
+    return self._decode(term)[0]
+
+  def term_frequencies(self, term: str) -> dict[int, tuple[int, ...]]:
+    ids, freqs = self._decode(term)
+    return dict(zip(ids, freqs))
+
+  def field_lengths(self, doc_id: int) -> tuple[int, ...] | None:
+    table = self._docs()
+    pos = bisect_left(self._doc_ids, doc_id)
+    if pos < self.doc_count and self._doc_ids[pos] == doc_id:
+      stride = self._nfields + 1
+      return tuple(table[pos * stride + 1:(pos + 1) * stride])
+    return None
+
+  def stats(self) -> tuple[int, tuple[int, ...]]:
+    if self._totals is None:
+      table = self._docs()
+      stride = self._nfields + 1
+      self._totals = tuple(sum(table[k::stride]) for k in range(1, stride))
+    return self.doc_count, self._totals
+
+
+class LayeredIndex:
+  # segmento en disco (puede no haber) + cambios en memoria desde que se genero.
+  # Los documentos editados o borrados despues se ocultan del segmento.
+  def __init__(self, fields, segment: Segment | None = None):
+    self.fields = tuple(fields)
+    self.segment = segment
+    self.delta = InvertedIndex(fields)
+    self._hidden: set[int] = set()
+    self._lock = threading.RLock()
+
+  def __contains__(self, doc_id):
+    if doc_id in self.delta:
+      return True
+    return (
+      self.segment is not None
+      and doc_id not in self._hidden
+      and self.segment.field_lengths(doc_id) is not None
+    )
+
+  def _hide(self, doc_id: int):
+    # solo se ocultan ids que estan en el segmento (las estadisticas cuentan con eso)
+    if self.segment is not None and self.segment.field_lengths(doc_id) is not None:
+      self._hidden.add(doc_id)
+
+  def add(self, doc_id: int, values: dict):
+    with self._lock:
+      self._hide(doc_id)
+      self.delta.add(doc_id, values)
+
+  def add_frequencies(self, doc_id: int, freqs: dict):
+    with self._lock:
+      self._hide(doc_id)
+      self.delta.add_frequencies(doc_id, freqs)
+
+  def remove(self, doc_id: int):
+    with self._lock:
+      self._hide(doc_id)
+      self.delta.remove(doc_id)
+
+  def postings(self, term: str) -> list[int]:
+    own = self.delta.postings(term)
+    if self.segment is None:
+      return own
+    base = self.segment.postings(term)
+    if self._hidden:
+      base = [doc_id for doc_id in base if doc_id not in self._hidden]
+    if not own:
+      return base
+    return sorted(set(base).union(own))
+
+  def expand_prefix(self, prefix: str) -> list[str]:
+    terms = self.delta.expand_prefix(prefix)
+    if self.segment is None:
+      return terms
+    return sorted(set(terms).union(self.segment.expand_prefix(prefix)))
+
+  def term_frequencies(self, term: str) -> dict[int, tuple[int, ...]]:
+    freqs = self.delta.term_frequencies(term)
+    if self.segment is None:
+      return freqs
+    base = self.segment.term_frequencies(term)
+    if self._hidden:
+      base = {doc_id: tf for doc_id, tf in base.items() if doc_id not in self._hidden}
+    base.update(freqs)
+    return base
+
+  def field_lengths(self, doc_id: int) -> tuple[int, ...] | None:
+    lengths = self.delta.field_lengths(doc_id)
+    if lengths is None and self.segment is not None and doc_id not in self._hidden:
+      lengths = self.segment.field_lengths(doc_id)
+    return lengths
+
+  def stats(self) -> tuple[int, tuple[int, ...]]:
+    count, totals = self.delta.stats()
+    if self.segment is None:
+      return count, totals
+    seg_count, seg_totals = self.segment.stats()
+    totals = [a + b for a, b in zip(totals, seg_totals)]
+    for doc_id in list(self._hidden):
+      for pos, size in enumerate(self.segment.field_lengths(doc_id)):
+        totals[pos] -= size
+    return count + seg_count - len(self._hidden), tuple(totals)
+
+  def search(self, query: str) -> list[int]:
+    with self._lock:
+      return run_query(self, query)
+
+  def score(self, query: str, weights: dict) -> dict[int, float]:
+    with self._lock:
+      return bm25_scores(self, query, weights)
+
+
+#--------------------
+#Versiones publicadas: <nombre>-<version>.idx + un puntero <nombre>.current que se reemplaza atomicamente.
+#Se usa un puntero (y no se pisa el .idx) porque en Windows no se puede reemplazar un archivo mapeado.
+def current_segment_path(directory: str, name: str) -> str | None:
+  try:
+    with open(os.path.join(directory, f"{name}.current"), "r", encoding="utf-8") as f:
+      filename = f.read().strip()
+  except FileNotFoundError:
+    return None
+  path = os.path.join(directory, filename)
+  return path if filename and os.path.exists(path) else None
+
+
+def publish_segment(directory: str, name: str, index: InvertedIndex, watermark: str = "", keep: int = 2) -> str:
+  os.makedirs(directory, exist_ok=True)
+  filename = f"{name}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}.idx"
+  path = os.path.join(directory, filename)
+  write_segment(path + ".tmp", index, watermark)
+  os.replace(path + ".tmp", path)
+
+  pointer = os.path.join(directory, f"{name}.current")
+  with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+    f.write(filename)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(pointer + ".tmp", pointer)
+
+  # se conservan las ultimas versiones porque algun worker puede seguir leyendo la anterior
+  versions = sorted(
+    f for f in os.listdir(directory) if f.startswith(f"{name}-") and f.endswith(".idx")
+  )
+  for old in versions[:-keep]:
+    try:
+      os.remove(os.path.join(directory, old))
+    except OSError:
+      pass
+  return path
@@ -0,0 +1,74 @@
+import threading
+from bisect import bisect_left, insort
+
+from .text import tokenize
+
+
+class TitleSuggester:
+  # autocompletado de titulos: arreglo ordenado de claves normalizadas + bisect.
+  # Cada titulo entra una vez por palabra ("harry potter", "potter"), asi "pot" tambien lo encuentra
+  def __init__(self):
+    self._keys: list[tuple[str, int]] = []
+    self._titles: dict[int, tuple[str, list[str]]] = {}
+    self._lock = threading.RLock()
+
+  def __len__(self):
+    return len(self._titles)
+
+  @staticmethod
+  def _keys_for(title: str) -> list[str]:
+    words = tokenize(title)
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+  def build(self, rows):
+    # carga inicial: se ordena una sola vez en lugar de insertar de a uno
+    keys = []
+    titles = {}
+    for book_id, title in rows:
+      own = self._keys_for(title)
+      titles[book_id] = (title, own)
+      keys.extend((key, book_id) for key in own)
+    keys.sort()
+    with self._lock:
+      self._keys = keys
+      self._titles = titles
+
+  def add(self, book_id: int, title: str):
+    with self._lock:
+      self._remove(book_id)
+      own = self._keys_for(title)
+      for key in own:
+        insort(self._keys, (key, book_id))
+      self._titles[book_id] = (title, own)
+
+  def remove(self, book_id: int):
+    with self._lock:
+      self._remove(book_id)
+
+  def _remove(self, book_id: int):
+    entry = self._titles.pop(book_id, None)
+    if entry is None:
+      return
+    for key in entry[1]:
+      pos = bisect_left(self._keys, (key, book_id))
+      if pos < len(self._keys) and self._keys[pos] == (key, book_id):
+        del self._keys[pos]
+
+  def suggest(self, prefix: str, limit: int = 8) -> list[tuple[int, str]]:
+    # (id, titulo) de los titulos con alguna palabra que empiece con prefix, sin repetir libros
+    prefix = " ".join(tokenize(prefix))
+    if not prefix:
+      return []
+    out = []
+    seen = set()
+    with self._lock:
+      pos = bisect_left(self._keys, (prefix, -1))
+      while pos < len(self._keys) and len(out) < limit:
+        key, book_id = self._keys[pos]
+        if not key.startswith(prefix):
+          break
+        if book_id not in seen:
+          seen.add(book_id)
+          out.append((book_id, self._titles[book_id][0]))
+        pos += 1
+    return out
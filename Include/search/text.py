@@ -0,0 +1,27 @@
+import re
+import unicodedata
+
+# letras/numeros sin "_" para que "_cursiva_" de markdown no quede pegado
+_WORD_RE = re.compile(r"[^\W_]+")
+
+# largo minimo del ultimo termino para buscarlo como prefijo ("harr" -> harry)
+MIN_PREFIX_LEN = 3
+
+
+def fold(text: str) -> str:
+  # minusculas y sin tildes/dieresis: "Canción" -> "cancion", "pingüino" -> "pinguino", "ñandú" -> "nandu"
+  decomposed = unicodedata.normalize("NFKD", text.lower())
+  return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text) -> list[str]:
+  if not text:
+    return []
+  return _WORD_RE.findall(fold(text))
+
+
+def iter_words(text: str):
+  # (termino normalizado, inicio, fin) sobre el texto original, para armar snippets
+  for match in _WORD_RE.finditer(text):
+    for term in _WORD_RE.findall(fold(match.group())):
+      yield term, match.start(), match.end()
@@ -0,0 +1,77 @@
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+from urllib.parse import quote
+
+from flask import abort, current_app, redirect, send_file
+
+#--------------------
+#Entrega de /uploads. Despues del chequeo de sesion (en la ruta) hay tres modos (UPLOADS_SERVE_MODE):
+#  "python"     -> Flask manda el archivo, con Range (206) y 304 usando un ETag fuerte = sha256 del contenido
+#  "x-accel"    -> nginx manda el archivo; la app solo responde el header X-Accel-Redirect:
+#                    location /protected-uploads/ { internal; alias /ruta/a/uploads/; }
+#  "x-sendfile" -> lo mismo para Apache (mod_xsendfile) / lighttpd con el header X-Sendfile
+#En los dos ultimos el proxy se encarga de Range, ETag y 304 y el worker no empuja bytes.
+#Con un backend sin disco local (S3) el modo no importa: se redirige a una URL firmada de vida corta
+#(UPLOADS_URL_EXPIRES segundos) y el bucket atiende Range/ETag.
+
+
+@lru_cache(maxsize=2048)
+def _content_hash(path: str, size: int, mtime_ns: int) -> str:
+  # (size, mtime) en la clave: si el archivo cambia se vuelve a calcular
+  hasher = hashlib.sha256()
+  with open(path, "rb") as f:
+    while chunk := f.read(1024 * 1024):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
+_BLOB_RE = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.\w+$")
+
+
+def content_etag(path: str, filename: str = "") -> str:
+  # los blobs ya se llaman por su sha256: no hace falta leerlos
+  match = _BLOB_RE.match(filename)
+  if match:
+    return match.group(1)
+  st = os.stat(path)
+  return _content_hash(path, st.st_size, st.st_mtime_ns)
+
+
+def send_upload(filename: str):
+  backend = current_app.extensions["blob_storage"].backend
+  mode = current_app.config.get("UPLOADS_SERVE_MODE", "python")
+  try:
+    path = backend.local_path(filename)
+  except FileNotFoundError:
+    abort(404)
+
+  if path is None:
+    response = redirect(backend.presigned_url(filename, current_app.config.get("UPLOADS_URL_EXPIRES", 300)))
+    # la URL vence: que nadie guarde la redireccion
+    response.cache_control.no_store = True
+    return response
+
+  if not os.path.isfile(path):
+    abort(404)
+  if mode in ("x-accel", "x-sendfile"):
+    response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+    if mode == "x-accel":
+      prefix = current_app.config.get("UPLOADS_ACCEL_PREFIX", "/protected-uploads/")
+      response.headers["X-Accel-Redirect"] = prefix + quote(filename)
+    else:
+      response.headers["X-Sendfile"] = os.path.abspath(path)
+  else:
+    response = send_file(
+      path,
+      as_attachment=False,
+      conditional=True,
+      etag=content_etag(path, filename),
+    )
+    # los visores de PDF solo piden por rangos si el primer 200 lo anuncia
+    response.headers.setdefault("Accept-Ranges", "bytes")
+  # detras de login: que no lo guarde ningun cache compartido
+  response.cache_control.private = True
+  return response
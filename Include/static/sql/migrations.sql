@@ -0,0 +1,72 @@
+-- Cambios de esquema para bases creadas antes de cada cambio (db.create_all no altera tablas existentes)
+
+-- indice para sincronizar el buscador por fecha de actualizacion
+CREATE INDEX ix_books_last_update_date ON books (last_update_date);
+
+-- terminos y snippets de cada capitulo, calculados al subirlo (buscador de contenido)
+CREATE TABLE chapter_terms (
+  chapter_id INT NOT NULL PRIMARY KEY,
+  terms LONGTEXT NOT NULL,
+  snippets LONGTEXT NOT NULL,
+  CONSTRAINT fk_chapter_terms_chapter FOREIGN KEY (chapter_id) REFERENCES chapters (id) ON DELETE CASCADE
+);
+-- despues: flask search-index chapters-backfill
+
+-- contador de capitulos desnormalizado (orden "Cantidad de capitulos" sin GROUP BY)
+ALTER TABLE books ADD COLUMN chapters_count INT NOT NULL DEFAULT 0;
+CREATE INDEX ix_books_chapters_count_title ON books (chapters_count DESC, title);
+-- despues: flask --app app chapters-count-repair
+
+-- hash del .md de cada capitulo: el HTML se renderiza una vez al subirlo (<archivo>.<hash>.html)
+ALTER TABLE chapters ADD COLUMN content_hash VARCHAR(64) NULL;
+-- despues: flask --app app chapters-render
+
+-- archivos subidos guardados por contenido (ab/cd/<sha256><ext>) con contador de referencias
+CREATE TABLE blobs (
+  sha256 VARCHAR(64) NOT NULL PRIMARY KEY,
+  ext VARCHAR(10) NOT NULL,
+  size BIGINT NOT NULL,
+  refcount INT NOT NULL DEFAULT 0,
+  creation_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+ALTER TABLE chapters ADD COLUMN blob_sha256 VARCHAR(64) NULL;
+ALTER TABLE chapters ADD CONSTRAINT fk_chapters_blob FOREIGN KEY (blob_sha256) REFERENCES blobs (sha256);
+CREATE INDEX ix_chapters_blob_sha256 ON chapters (blob_sha256);
+-- despues: flask --app app uploads-migrate
+
+-- subidas por partes (capitulos grandes, se pueden retomar)
+CREATE TABLE upload_sessions (
+  id VARCHAR(32) NOT NULL PRIMARY KEY,
+  user_id INT NOT NULL,
+  book_id INT NOT NULL,
+  filename VARCHAR(255) NOT NULL,
+  ext VARCHAR(10) NOT NULL,
+  size BIGINT NOT NULL,
+  received BIGINT NOT NULL DEFAULT 0,
+  creation_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  last_update_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  INDEX ix_upload_sessions_user_id (user_id),
+  INDEX ix_upload_sessions_book_id (book_id),
+  CONSTRAINT fk_upload_sessions_user FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+  CONSTRAINT fk_upload_sessions_book FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
+);
+-- limpieza periodica: flask --app app uploads-expire
+
+-- indices compuestos segun las consultas reales (filtro + orden en el mismo indice).
+-- Primero el compuesto y despues se borra el simple: la FK siempre tiene un indice que la cubre
+CREATE INDEX ix_books_creator_user_id_creation_date ON books (creator_user_id, creation_date);
+CREATE INDEX ix_books_creation_date ON books (creation_date);
+CREATE INDEX ix_chapters_book_id_id ON chapters (book_id, id);
+DROP INDEX ix_chapters_book_id ON chapters;
+CREATE INDEX ix_comments_book_id_id ON comments (book_id, id);
+DROP INDEX ix_comments_book_id ON comments;
+-- despues: flask --app app db-plan-check
+
+-- bajas de los indices de busqueda (los otros workers las levantan al sincronizar)
+CREATE TABLE search_tombstones (
+  id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  index_name VARCHAR(20) NOT NULL,
+  doc_id INT NOT NULL,
+  creation_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  INDEX ix_search_tombstones_creation_date (creation_date)
+);
@@ -0,0 +1,2 @@
+from .backends import Stat, StorageBackend, LocalStorage, S3Storage, create_backend
+from .blobs import BlobStorage, blob_storage
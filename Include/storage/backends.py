@@ -0,0 +1,246 @@
+import io
+import mimetypes
+import os
+import uuid
+
+from werkzeug.security import safe_join
+
+#--------------------
+#Donde viven los archivos subidos. Toda la app pasa por esta interfaz con claves relativas
+#("ab/cd/<sha256>.pdf", o el nombre viejo de los archivos sin migrar), nunca por rutas:
+#  LocalStorage -> un directorio (UPLOAD_FOLDER), como siempre
+#  S3Storage    -> un bucket S3 o compatible (MinIO, moto_server...), para que varios nodos web
+#                  compartan los archivos sin compartir disco
+#Los temporales (subidas en curso, renders a medio escribir) son siempre locales: tmp_path()
+
+
+class Stat:
+  def __init__(self, size: int, mtime_ns: int):
+    self.size = size
+    self.mtime_ns = mtime_ns
+
+
+class StorageBackend:
+  tmp_dir = None
+
+  def open(self, key: str):
+    # archivo binario de solo lectura (FileNotFoundError si no existe)
+    raise NotImplementedError
+
+  def read_range(self, key: str, offset: int, length: int) -> bytes:
+    raise NotImplementedError
+
+  def save(self, key: str, stream):
+    # copia el stream de a pedazos, sin cargarlo entero
+    raise NotImplementedError
+
+  def put_file(self, key: str, source: str):
+    # sube un archivo local (temporal) y lo saca de su lugar
+    raise NotImplementedError
+
+  def delete(self, key: str):
+    # no falla si ya no existe
+    raise NotImplementedError
+
+  def stat(self, key: str) -> Stat | None:
+    raise NotImplementedError
+
+  def list(self, prefix: str):
+    # claves que empiezan con prefix
+    raise NotImplementedError
+
+  def presigned_url(self, key: str, expires: int = 300) -> str | None:
+    # URL temporal para bajar el archivo sin pasar por la app; None si el backend no tiene
+    return None
+
+  def local_path(self, key: str) -> str | None:
+    # ruta en disco si la hay (X-Sendfile / X-Accel-Redirect)
+    return None
+
+  def tmp_path(self, name: str) -> str:
+    os.makedirs(self.tmp_dir, exist_ok=True)
+    return os.path.join(self.tmp_dir, name)
+
+
+class LocalStorage(StorageBackend):
+  def __init__(self, root: str, tmp_dir: str | None = None):
+    self.root = root
+    # en el mismo disco que los archivos, asi pasar al lugar final es un rename
+    self.tmp_dir = tmp_dir or os.path.join(root, "tmp")
+
+  def path(self, key: str) -> str:
+    path = safe_join(self.root, key)
+    if path is None:
+      raise FileNotFoundError(key)
+    return path
+
+  def open(self, key: str):
+    return open(self.path(key), "rb")
+
+  def read_range(self, key: str, offset: int, length: int) -> bytes:
+    with self.open(key) as f:
+      f.seek(offset)
+      return f.read(length)
+
+  def save(self, key: str, stream):
+    tmp = self.tmp_path(uuid.uuid4().hex)
+    try:
+      with open(tmp, "wb") as f:
+        while chunk := stream.read(1024 * 1024):
+          f.write(chunk)
+      self.put_file(key, tmp)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  def put_file(self, key: str, source: str):
+    target = self.path(key)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(source, target)
+
+  def delete(self, key: str):
+    try:
+      os.remove(self.path(key))
+    except FileNotFoundError:
+      pass
+
+  def stat(self, key: str) -> Stat | None:
+    try:
+      st = os.stat(self.path(key))
+    except FileNotFoundError:
+      return None
+    return Stat(st.st_size, st.st_mtime_ns)
+
+  def list(self, prefix: str):
+    directory, _, start = prefix.rpartition("/")
+    try:
+      entries = os.scandir(self.path(directory) if directory else self.root)
+    except FileNotFoundError:
+      return
+    with entries:
+      for entry in entries:
+        if entry.is_file() and entry.name.startswith(start):
+          yield f"{directory}/{entry.name}" if directory else entry.name
+
+  def local_path(self, key: str) -> str | None:
+    return self.path(key)
+
+
+class S3Storage(StorageBackend):
+  # boto3 (en requeriments.txt) se importa recien cuando se usa este backend.
+  # endpoint_url apunta a cualquier servidor compatible; para probar sin AWS:
+  #   moto_server -p 5000   o   minio server /data
+  def __init__(self, bucket: str, tmp_dir: str, prefix: str = "", endpoint_url: str | None = None,
+               region: str | None = None):
+    self.bucket = bucket
+    self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+    self.tmp_dir = tmp_dir
+    self.endpoint_url = endpoint_url
+    self.region = region
+    self._client = None
+
+  @property
+  def client(self):
+    if self._client is None:
+      try:
+        import boto3
+      except ImportError:
+        raise RuntimeError("STORAGE_BACKEND = 's3' necesita boto3 (pip install boto3)")
+      self._client = boto3.client("s3", endpoint_url=self.endpoint_url, region_name=self.region)
+    return self._client
+
+  def _key(self, key: str) -> str:
+    return self.prefix + key
+
+  def _missing(self, error) -> bool:
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+  def _get(self, key: str, **params):
+    from botocore.exceptions import ClientError
+    try:
+      return self.client.get_object(Bucket=self.bucket, Key=self._key(key), **params)
+    except ClientError as e:
+      if self._missing(e):
+        raise FileNotFoundError(key) from e
+      raise
+
+  def open(self, key: str):
+    # el cuerpo llega en streaming; con buffer se puede leer por lineas como un archivo
+    return io.BufferedReader(_BodyReader(self._get(key)["Body"]), 1024 * 1024)
+
+  def read_range(self, key: str, offset: int, length: int) -> bytes:
+    if length <= 0:
+      return b""
+    return self._get(key, Range=f"bytes={offset}-{offset + length - 1}")["Body"].read()
+
+  def _extra_args(self, key: str) -> dict:
+    return {"ContentType": mimetypes.guess_type(key)[0] or "application/octet-stream"}
+
+  def save(self, key: str, stream):
+    # upload_fileobj manda por partes (multipart) los archivos grandes
+    self.client.upload_fileobj(stream, self.bucket, self._key(key), ExtraArgs=self._extra_args(key))
+
+  def put_file(self, key: str, source: str):
+    self.client.upload_file(source, self.bucket, self._key(key), ExtraArgs=self._extra_args(key))
+    os.remove(source)
+
+  def delete(self, key: str):
+    self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+  def stat(self, key: str) -> Stat | None:
+    from botocore.exceptions import ClientError
+    try:
+      head = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+    except ClientError as e:
+      if self._missing(e):
+        return None
+      raise
+    return Stat(head["ContentLength"], int(head["LastModified"].timestamp()) * 1_000_000_000)
+
+  def list(self, prefix: str):
+    pages = self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self._key(prefix))
+    for page in pages:
+      for item in page.get("Contents", ()):
+        yield item["Key"][len(self.prefix):]
+
+  def presigned_url(self, key: str, expires: int = 300) -> str | None:
+    return self.client.generate_presigned_url(
+      "get_object",
+      Params={"Bucket": self.bucket, "Key": self._key(key)},
+      ExpiresIn=expires,
+    )
+
+
+class _BodyReader(io.RawIOBase):
+  # adapta el StreamingBody de botocore a RawIOBase (para BufferedReader)
+  def __init__(self, body):
+    self.body = body
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    data = self.body.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+  def close(self):
+    self.body.close()
+    super().close()
+
+
+def create_backend(config) -> StorageBackend:
+  # STORAGE_BACKEND = "local" (default) | "s3"
+  kind = config.get("STORAGE_BACKEND", "local")
+  tmp_dir = config.get("STORAGE_TMP_FOLDER")
+  if kind == "local":
+    return LocalStorage(config["UPLOAD_FOLDER"], tmp_dir)
+  if kind == "s3":
+    return S3Storage(
+      config["S3_BUCKET"],
+      tmp_dir or os.path.join(config["UPLOAD_FOLDER"], "tmp"),
+      prefix=config.get("S3_PREFIX", ""),
+      endpoint_url=config.get("S3_ENDPOINT_URL"),
+      region=config.get("S3_REGION"),
+    )
+  raise ValueError(f"STORAGE_BACKEND desconocido: {kind}")
@@ -0,0 +1,87 @@
+import hashlib
+import os
+import uuid
+
+from models import db, Blob, blob_key, reserve_blob
+from rendering import remove_rendered
+from .backends import create_backend
+
+#--------------------
+#Almacenamiento de los archivos subidos por contenido: cada archivo se guarda una sola vez como
+#ab/cd/<sha256><ext> en el backend (ver backends.py). Si dos capitulos suben el mismo PDF comparten
+#el blob (Blob.refcount) y cuando ningun capitulo lo usa se borra.
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStorage:
+  def __init__(self):
+    self.backend = None
+
+  def init_app(self, app):
+    self.backend = create_backend(app.config)
+    app.extensions["blob_storage"] = self
+
+  def tmp_path(self, name: str) -> str:
+    return self.backend.tmp_path(name)
+
+  def save(self, stream, ext: str) -> Blob:
+    # copia el stream a un temporal calculando el sha256 en la misma pasada y despues lo sube
+    # a su lugar (si ya existia ese contenido el temporal se descarta)
+    tmp = self.tmp_path(uuid.uuid4().hex)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+      with open(tmp, "wb") as f:
+        while chunk := stream.read(CHUNK_SIZE):
+          hasher.update(chunk)
+          f.write(chunk)
+          size += len(chunk)
+      return self._store(tmp, hasher.hexdigest(), ext, size)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  def import_file(self, source: str, ext: str) -> Blob:
+    # un archivo que ya esta en disco (subidas por partes, uploads-migrate): se lee para el hash
+    # y se mueve, no se copia
+    hasher = hashlib.sha256()
+    with open(source, "rb") as f:
+      while chunk := f.read(CHUNK_SIZE):
+        hasher.update(chunk)
+    blob = self._store(source, hasher.hexdigest(), ext, os.path.getsize(source))
+    if os.path.exists(source):
+      os.remove(source)
+    return blob
+
+  def _store(self, source: str, sha256: str, ext: str, size: int) -> Blob:
+    # la referencia se toma antes de mirar el archivo: con la fila bloqueada, collect() no puede
+    # borrarlo entre que se ve que esta y que se commitea el capitulo
+    reserve_blob(db.session, sha256, ext, size)
+    blob = db.session.get(Blob, sha256, populate_existing=True)
+    if self.backend.stat(blob.key) is None:
+      self.backend.put_file(blob.key, source)
+    return blob
+
+  def collect(self, shas):
+    # despues del commit: borra los blobs que quedaron sin referencias. El archivo se borra dentro de
+    # la transaccion del DELETE (condicional: refcount <= 0), con la fila bloqueada: una subida del
+    # mismo contenido espera en reserve_blob y despues, como el archivo ya no esta, lo vuelve a subir
+    blobs = db.metadata.tables["blobs"]
+    for sha256 in shas:
+      with db.engine.begin() as connection:
+        row = connection.execute(
+          db.select(blobs.c.ext).where(blobs.c.sha256 == sha256, blobs.c.refcount <= 0).with_for_update()
+        ).first()
+        if row is None:
+          continue
+        deleted = connection.execute(
+          blobs.delete().where(blobs.c.sha256 == sha256, blobs.c.refcount <= 0)
+        ).rowcount
+        if deleted:
+          key = blob_key(sha256, row.ext)
+          self.backend.delete(key)
+          remove_rendered(self.backend, key)
+
+
+blob_storage = BlobStorage()
@@ -0,0 +1,57 @@
+import os
+import sys
+import types
+
+import pytest
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+  # la app lee config.py (ver config.template): para los tests, una base sqlite temporal
+  tmp = tmp_path_factory.mktemp("bksh")
+  config = types.ModuleType("config")
+  config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp / 'test.db'}"
+  config.SECRET_KEY = "test"
+  sys.modules["config"] = config
+
+  from app import app, db, Rank, blob_storage, book_search, chapter_search
+  # archivos e indices tambien en el temporal: los servicios leen la config en init_app
+  app.config.update(
+    TESTING=True,
+    STORAGE_BACKEND="local",
+    UPLOAD_FOLDER=str(tmp / "uploads"),
+    STORAGE_TMP_FOLDER=None,
+    SEARCH_INDEX_DIR=str(tmp / "search"),
+  )
+  for service in (blob_storage, book_search, chapter_search):
+    service.init_app(app)
+  with app.app_context():
+    # como en MySQL: los ON DELETE CASCADE se cumplen (sqlite los ignora si no se activan)
+    event.listen(db.engine, "connect", lambda connection, _: connection.execute("PRAGMA foreign_keys=ON"))
+    db.engine.dispose()
+    db.create_all(bind_key=None)
+    db.session.add(Rank(rank="User"))
+    db.session.commit()
+  return app
+
+
+@pytest.fixture
+def client(app):
+  from app import db, User, Book
+  with app.app_context():
+    user = User(username=f"u{User.query.count()}", email=f"u{User.query.count()}@example.invalid", rank_id=1)
+    user.password = "p"
+    db.session.add(user)
+    db.session.commit()
+    book = Book(title="Libro", creator_user_id=user.id)
+    db.session.add(book)
+    db.session.commit()
+    user_id, book_id = user.id, book.id
+  client = app.test_client()
+  with client.session_transaction() as s:
+    s["user_id"] = user_id
+  client.book_id = book_id
+  return client
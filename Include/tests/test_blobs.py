@@ -0,0 +1,54 @@
+import io
+import threading
+
+
+def _upload(app, book_id, data, results):
+  from app import db, Book, add_chapter, blob_storage
+  with app.test_request_context():
+    try:
+      blob = blob_storage.save(io.BytesIO(data), ".txt")
+      results.append(add_chapter(db.session.get(Book, book_id), "Capitulo", blob).id)
+    except Exception as e:
+      results.append(e)
+    finally:
+      db.session.remove()
+
+
+def test_same_file_uploaded_concurrently(app, client):
+  # dos subidas del mismo contenido a la vez: las dos crean su capitulo y comparten el blob
+  from app import db, Chapter, blob_storage
+  from models import Blob
+  data = b"contenido repetido"
+  results = []
+  threads = [threading.Thread(target=_upload, args=(app, client.book_id, data, results)) for _ in range(2)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert all(isinstance(r, int) for r in results), results
+
+  with app.app_context():
+    chapters = [db.session.get(Chapter, id) for id in results]
+    blob = chapters[0].blob
+    assert blob.refcount == 2
+    assert blob_storage.backend.stat(blob.key) is not None
+
+    # sin referencias se borran la fila y el archivo
+    key, sha256 = blob.key, blob.sha256
+    for chapter in chapters:
+      db.session.delete(chapter)
+      db.session.commit()
+    assert db.session.get(Blob, sha256) is None
+    assert blob_storage.backend.stat(key) is None
+
+
+def test_unused_reservation_is_released(app):
+  # un archivo guardado que no termina en un capitulo no queda referenciado
+  from app import db, blob_storage
+  from models import Blob
+  with app.app_context():
+    blob = blob_storage.save(io.BytesIO(b"subida abandonada"), ".txt")
+    key, sha256 = blob.key, blob.sha256
+    db.session.commit()
+    assert db.session.get(Blob, sha256) is None
+    assert blob_storage.backend.stat(key) is None
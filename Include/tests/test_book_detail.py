@@ -0,0 +1,12 @@
+def test_title_with_more_comments(app, client):
+  # con mas de una pagina de comentarios el <title> sigue siendo solo el del libro
+  from app import db, Book, Comment
+  with app.app_context():
+    book = db.session.get(Book, client.book_id)
+    for i in range(app.config["COMMENTS_PER_PAGE"] + 1):
+      db.session.add(Comment(commentator_user_id=book.creator_user_id, book_id=book.id, content=f"c{i}"))
+    db.session.commit()
+
+  html = client.get(f"/books/{client.book_id}").get_data(as_text=True)
+  assert "<title>Libro – BKSH</title>" in html
+  assert html.count("<script>\n  // \"Cargar más\"") == 1
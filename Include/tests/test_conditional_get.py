@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+from werkzeug.http import http_date
+
+
+def test_if_modified_since_only(client):
+  url = f"/books/{client.book_id}"
+  first = client.get(url)
+  assert first.status_code == 200
+  assert first.last_modified is not None
+
+  # sin If-None-Match: se decide por la fecha (naive en la db, aware en el header)
+  cached = client.get(url, headers={"If-Modified-Since": first.headers["Last-Modified"]})
+  assert cached.status_code == 304
+
+  old = http_date(datetime.now(timezone.utc) - timedelta(days=1))
+  assert client.get(url, headers={"If-Modified-Since": old}).status_code == 200
+
+
+def test_pending_flash_is_not_a_304(client):
+  url = f"/books/{client.book_id}"
+  first = client.get(url)
+  etag = first.headers["ETag"]
+  assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+  # un POST que solo deja un mensaje: el GET siguiente tiene que mostrarlo
+  response = client.post(url, data={"action": "create_comment", "content": "  "})
+  assert response.status_code == 302
+  shown = client.get(url, headers={"If-None-Match": etag, "If-Modified-Since": first.headers["Last-Modified"]})
+  assert shown.status_code == 200
+  assert "El comentario no puede estar vacío" in shown.get_data(as_text=True)
+
+  # ya mostrado: vuelve el 304 (y no se repite el mensaje)
+  assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_head(client):
+  # Flask atiende HEAD con la ruta GET: mismos validadores, sin cuerpo
+  url = f"/books/{client.book_id}"
+  etag = client.get(url).headers["ETag"]
+  head = client.head(url)
+  assert head.status_code == 200
+  assert head.headers["ETag"] == etag
+  assert head.get_data() == b""
+  assert client.head(url, headers={"If-None-Match": etag}).status_code == 304
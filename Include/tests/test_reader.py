@@ -0,0 +1,34 @@
+import io
+import time
+
+
+def test_large_chapter_rendered_after_timeout(app, client, monkeypatch):
+  # el pool no llego a tiempo con un capitulo enorme: se lee en streaming y se re-renderiza de fondo
+  from app import db, Book, Chapter, add_chapter, blob_storage, render_service
+  from rendering import plain_html, read_index, render_markdown
+
+  def render(text, wait=False):
+    return (render_markdown(text), True) if wait else (plain_html(text), False)
+
+  monkeypatch.setattr(render_service, "render", render)
+  monkeypatch.setitem(app.config, "READER_STREAM_THRESHOLD", 10)
+  with app.test_request_context():
+    blob = blob_storage.save(io.BytesIO(b"# Uno\n\nTexto *largo*.\n"), ".md")
+    chapter = add_chapter(db.session.get(Book, client.book_id), "Enorme", blob)
+    chapter_id, key, content_hash = chapter.id, blob.key, chapter.content_hash
+  assert read_index(blob_storage.backend, key, content_hash) is None
+
+  degraded = client.get(f"/chapters/{chapter_id}")
+  assert degraded.status_code == 200
+  assert "no-store" in degraded.headers["Cache-Control"] and "ETag" not in degraded.headers
+  assert "<pre" in degraded.get_data(as_text=True)
+
+  for _ in range(100):
+    if read_index(blob_storage.backend, key, content_hash) is not None:
+      break
+    time.sleep(0.05)
+  assert read_index(blob_storage.backend, key, content_hash) is not None
+  assert render_service.stats()["background_errors"] == 0
+
+  rendered = client.get(f"/chapters/{chapter_id}").get_data(as_text=True)
+  assert "<em>largo</em>" in rendered
@@ -0,0 +1,83 @@
+from sqlalchemy import event
+
+
+def test_suggest_drops_books_deleted_in_other_workers(app, client):
+  from app import db, Book, book_search
+  with app.app_context():
+    book = Book(title="Zanahoria voladora", creator_user_id=db.session.get(Book, client.book_id).creator_user_id)
+    db.session.add(book)
+    db.session.commit()
+    book_id = book.id
+    assert (book_id, "Zanahoria voladora") in book_search.suggest("zanah")
+
+    # otro worker lo borra: este proceso no recibe el cambio por la sesion
+    db.session.delete(book)
+    db.session.flush()
+    db.session.info.pop("search_changes")
+    db.session.commit()
+    assert (book_id, "Zanahoria voladora") in book_search.suggest("zanah")
+
+    book_search._synced_at = 0  # vencio SEARCH_SYNC_INTERVAL: el proximo uso sincroniza
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, "before_cursor_execute", listener)
+    try:
+      book_search.index()
+      synced = len(statements)
+      assert book_search.suggest("zanah") == []
+    finally:
+      event.remove(db.engine, "before_cursor_execute", listener)
+    assert synced and len(statements) == synced  # el autocompletado no consulta la db
+
+
+def _other_worker_commit(db):
+  # commit de otro worker: este proceso no recibe el cambio por la sesion
+  db.session.flush()
+  db.session.info.pop("search_changes", None)
+  db.session.commit()
+
+
+def test_chapter_committed_late_is_indexed(app, client):
+  # un capitulo con id menor que commitea despues de que otro mayor ya se sincronizo
+  import json
+  from app import db, Chapter, ChapterTerms, chapter_search
+  with app.app_context():
+    chapter_search.index()
+    # ids propios: sqlite reusa los de capitulos borrados en otros tests
+    late = Chapter(id=10000, book_id=client.book_id, title="tarde", content_url="/uploads/tarde.md")
+    early = Chapter(id=10001, book_id=client.book_id, title="antes", content_url="/uploads/antes.md")
+    db.session.add_all([late, early])
+    db.session.flush()
+    early.search_terms = ChapterTerms(terms=json.dumps({"ornitorrinco": [0, 1]}), snippets="{}")
+    _other_worker_commit(db)
+    chapter_search._synced_at = 0
+    assert chapter_search.match_ids("ornitorrinco") == [early.id]
+
+    late.search_terms = ChapterTerms(terms=json.dumps({"ornitorrinco": [0, 2]}), snippets="{}")
+    _other_worker_commit(db)
+    chapter_search._synced_at = 0
+    assert chapter_search.match_ids("ornitorrinco") == sorted([late.id, early.id])
+
+
+def test_chapter_search_sends_a_bounded_in(app, client):
+  # muchos capitulos con el mismo termino: la consulta lleva solo los mas nuevos
+  import json
+  from app import db, Chapter, ChapterTerms, chapter_search
+  with app.app_context():
+    for i in range(200):
+      chapter = Chapter(id=20000 + i, book_id=client.book_id, title=f"c{i}", content_url="/uploads/c.md")
+      chapter.search_terms = ChapterTerms(terms=json.dumps({"capibara": [0, 1]}), snippets="{}")
+      db.session.add(chapter)
+    db.session.commit()
+    db.session.execute(db.delete(Chapter).where(Chapter.id >= 20195))  # los mas nuevos ya no estan
+    db.session.commit()
+
+    parameters = []
+    listener = lambda conn, cursor, statement, params, *args: parameters.append(params)
+    event.listen(db.engine, "before_cursor_execute", listener)
+    try:
+      results = chapter_search.search("capibara", limit=10)
+    finally:
+      event.remove(db.engine, "before_cursor_execute", listener)
+    assert [c.id for c, _ in results] == list(range(20194, 20184, -1))
+    assert max(len(p) for p in parameters) <= 2 * 10 + 2  # la ventana + LIMIT y OFFSET
@@ -0,0 +1,33 @@
+import os
+
+
+def test_finalize_without_part_file(app, client):
+  # el .part se borro (uploads-expire) con la sesion completa: 409 con mensaje y la sesion se descarta
+  from app import blob_storage
+  state = client.post(f"/books/{client.book_id}/uploads", json={"filename": "c.md", "size": 5}).get_json()
+  assert client.put(f"{state['url']}?offset=0", data=b"# uno").get_json() == {"received": 5}
+  os.remove(blob_storage.tmp_path(f"{state['id']}.part"))
+
+  response = client.post(f"{state['url']}/finalize", json={"title": "Uno"})
+  assert response.status_code == 409
+  assert response.get_json()["error"]
+  assert client.get(state["url"]).status_code == 404
+
+
+def test_uploads_expire(app, client):
+  # vencen las sesiones sin actividad en las ultimas --hours, medidas con la hora de la base
+  from datetime import timedelta
+  from app import db, UploadSession
+  from sqlalchemy import func
+  new = lambda: client.post(f"/books/{client.book_id}/uploads", json={"filename": "c.md", "size": 5}).get_json()["id"]
+  live, stale = new(), new()
+  with app.app_context():
+    now = db.session.execute(db.select(func.now())).scalar()
+    db.session.get(UploadSession, stale).last_update_date = now - timedelta(hours=2)
+    db.session.commit()
+
+  result = app.test_cli_runner().invoke(args=["uploads-expire", "--hours", "1"])
+  assert result.exit_code == 0, result.output
+  with app.app_context():
+    assert db.session.get(UploadSession, live) is not None
+    assert db.session.get(UploadSession, stale) is None